@@ -1,14 +1,27 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Request, Depends, Query, BackgroundTasks
-from fastapi.security import HTTPBasic, HTTPBasicCredentials
+from fastapi import FastAPI, APIRouter, HTTPException, Request, Depends, Query
+from fastapi.responses import Response, StreamingResponse, HTMLResponse
+from fastapi.encoders import jsonable_encoder
+from fastapi.security import HTTPBasic, HTTPBasicCredentials, HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, InsertOne, UpdateOne, UpdateMany, DeleteMany, IndexModel, ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError, ServerSelectionTimeoutError
 import os
 import logging
 import asyncio
+import bisect
 import hashlib
 import secrets
+import random
+import socket
 import json
+import time
+import base64
+import csv
+import io
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
 from typing import List, Optional, Dict
@@ -18,8 +31,12 @@ import stripe
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-import requests
-from ics import Calendar, Event
+from email.utils import format_datetime, parsedate_to_datetime
+from urllib.parse import quote
+import httpx
+import jinja2
+import numpy as np
+from ics import Calendar
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -35,8 +52,19 @@ client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ.get('DB_NAME', 'desideri_db')]
 
 # STRIPE CONFIGURATION
-stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
+STRIPE_SECRET_KEY = os.environ.get('STRIPE_SECRET_KEY')
 STRIPE_WEBHOOK_SECRET = os.environ.get('STRIPE_WEBHOOK_SECRET')
+# Base URL dell'API Stripe: in test/load si può puntare a stripe-mock (es. http://localhost:12111)
+STRIPE_API_BASE = os.environ.get('STRIPE_API_BASE', 'https://api.stripe.com')
+STRIPE_TIMEOUT = float(os.environ.get('STRIPE_TIMEOUT', 15))
+STRIPE_MAX_RETRIES = int(os.environ.get('STRIPE_MAX_RETRIES', 2))
+
+# HTTP client condiviso (pool di connessioni) per le chiamate esterne, es. feed iCal
+http_client = httpx.AsyncClient(
+    timeout=httpx.Timeout(10.0, connect=5.0),
+    limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+    follow_redirects=True
+)
 
 # --- EMAIL CONFIGURATION ---
 SMTP_HOST = os.environ.get('SMTP_HOST', 'smtp.office365.com')
@@ -44,6 +72,8 @@ SMTP_PORT = int(os.environ.get('SMTP_PORT', 587))
 SMTP_USER = os.environ.get('EMAIL_USER') 
 SMTP_PASSWORD = os.environ.get('EMAIL_PASS')
 SENDER_EMAIL = SMTP_USER 
+# STARTTLS disattivabile per server SMTP locali di test (es. aiosmtpd)
+SMTP_STARTTLS = os.environ.get('SMTP_STARTTLS', 'true').lower() in ('1', 'true', 'yes')
 
 # ADMIN CREDENTIALS
 ADMIN_USERNAME = "admin"
@@ -52,7 +82,23 @@ ADMIN_PASSWORD_HASH = hashlib.sha256(plain_password.encode()).hexdigest()
 
 # ==================== APP SETUP ====================
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    load_email_templates()
+    # Migrazioni, indici e cache partono in background: l'app risponde subito anche
+    # se Mongo non è ancora raggiungibile
+    tasks = [asyncio.create_task(startup_maintenance()), asyncio.create_task(email_outbox_worker())]
+    if ICAL_SYNC_ENABLED:
+        tasks.append(asyncio.create_task(ical_sync_scheduler()))
+    yield
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    mailer.close()
+    await payment_gateway.close()
+    await http_client.aclose()
+
+app = FastAPI(lifespan=lifespan)
 security = HTTPBasic()
 api_router = APIRouter(prefix="/api")
 
@@ -114,11 +160,13 @@ class Booking(BaseModel):
     status: str = "pending"
     payment_status: str = "pending"
     source: str = "website" 
+    external_uid: Optional[str] = None
     stripe_session_id: Optional[str] = None
     notes: Optional[str] = None
     stay_reason: Optional[str] = None
     coupon_code: Optional[str] = None
     discount_amount: float = 0.0
+    language: str = "it"
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
@@ -135,6 +183,7 @@ class BookingCreate(BaseModel):
     coupon_code: Optional[str] = None
     upsell_ids: Optional[List[str]] = None
     stay_reason: Optional[str] = None
+    language: str = "it"
 
 class ContactMessage(BaseModel):
     name: str
@@ -163,10 +212,18 @@ class CustomPrice(BaseModel):
     price: float
     reason: Optional[str] = None
 
-class CustomPriceCreate(BaseModel):
-    room_id: str
+class DateRange(BaseModel):
     start_date: str
     end_date: str
+
+class CustomPriceCreate(BaseModel):
+    # Forma semplice (una stanza, un intervallo) oppure più stanze/intervalli insieme
+    room_id: Optional[str] = None
+    room_ids: Optional[List[str]] = None
+    start_date: Optional[str] = None
+    end_date: Optional[str] = None
+    ranges: Optional[List[DateRange]] = None
+    weekdays: Optional[List[int]] = None  # 0 = lunedì ... 6 = domenica; None = tutti i giorni
     price: float
     reason: Optional[str] = None
 
@@ -255,159 +312,1377 @@ class SiteImagesUpdate(BaseModel):
     hero_image: Optional[str] = None
     cta_background: Optional[str] = None
 
-# ==================== EMAIL LOGIC ====================
-
-def _send_email_sync(to_email: str, subject: str, html_content: str):
-    """Sync function to send email via SMTP (Outlook/Gmail)"""
-    if not SMTP_USER or not SMTP_PASSWORD:
-        logger.error("Credenziali email mancanti - Controlla Environment Variables su Render")
+# ==================== IN-MEMORY CACHES ====================
+
+class LRUCache:
+    """Piccola cache LRU di processo, con scadenza opzionale delle voci (secondi)"""
+
+    def __init__(self, maxsize: int = 256, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        value, expires_at = item
+        if expires_at is not None and expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+# ==================== ADMIN AUTH ====================
+# I token di sessione validati restano in memoria per qualche minuto: le route admin
+# non interrogano admin_sessions a ogni richiesta. Il logout rimuove il token dalla
+# cache di questo processo; negli altri worker scade al più tardi dopo il TTL.
+
+ADMIN_SESSION_HOURS = 24
+admin_token_cache = LRUCache(maxsize=256, ttl=300)
+admin_bearer = HTTPBearer(auto_error=False)
+
+def _as_utc(value) -> datetime:
+    # Le sessioni vecchie hanno expires_at come stringa ISO; Motor restituisce date naive in UTC
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+async def is_admin_token_valid(token: Optional[str]) -> bool:
+    if not token:
         return False
+    expires_at = admin_token_cache.get(token)
+    if expires_at is None:
+        session = await db.admin_sessions.find_one({"token": token}, {"_id": 0, "expires_at": 1})
+        if not session:
+            return False
+        expires_at = _as_utc(session["expires_at"])
+        admin_token_cache.set(token, expires_at)
+    if expires_at <= datetime.now(timezone.utc):
+        admin_token_cache.pop(token)
+        return False
+    return True
+
+async def require_admin(
+    token: Optional[str] = Query(None),
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(admin_bearer)
+) -> str:
+    """Dipendenza per le route admin: token in ?token= oppure Authorization: Bearer"""
+    token = credentials.credentials if credentials else token
+    if not await is_admin_token_valid(token):
+        raise HTTPException(401, "Unauthorized")
+    return token
+
+# ==================== DATABASE INDEXES ====================
+
+# Registro dichiarativo degli indici, applicato all'avvio. Gli indici unique
+# rispecchiano le chiavi che il codice tratta come univoche.
+INDEXES: Dict[str, List[IndexModel]] = {
+    "rooms": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+    ],
+    "bookings": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("room_id", ASCENDING), ("status", ASCENDING), ("check_in", ASCENDING), ("check_out", ASCENDING)], name="room_status_stay"),
+        IndexModel([("stripe_session_id", ASCENDING)], name="stripe_session_unique", unique=True,
+                   partialFilterExpression={"stripe_session_id": {"$type": "string"}}),
+        IndexModel([("room_id", ASCENDING), ("source", ASCENDING), ("external_uid", ASCENDING)], name="room_source_uid_unique",
+                   unique=True, partialFilterExpression={"external_uid": {"$type": "string"}}),
+        IndexModel([("status", ASCENDING), ("check_in", ASCENDING)], name="status_check_in"),
+        IndexModel([("status", ASCENDING), ("check_out", ASCENDING)], name="status_check_out"),
+        IndexModel([("created_at", DESCENDING), ("id", DESCENDING)], name="created_at_id_desc"),
+    ],
+    "custom_prices": [
+        IndexModel([("room_id", ASCENDING), ("date", ASCENDING)], name="room_date_unique", unique=True),
+    ],
+    "blocked_dates": [
+        IndexModel([("room_id", ASCENDING), ("start", ASCENDING), ("end", ASCENDING)], name="room_start_end"),
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+    ],
+    "coupons": [
+        IndexModel([("code", ASCENDING)], name="code_unique", unique=True),
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+    ],
+    "upsells": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("slug", ASCENDING)], name="slug_unique", unique=True),
+        IndexModel([("order", ASCENDING)], name="order"),
+    ],
+    "admin_sessions": [
+        IndexModel([("token", ASCENDING)], name="token_unique", unique=True),
+        # Mongo elimina da solo le sessioni scadute (expires_at deve essere una data BSON)
+        IndexModel([("expires_at", ASCENDING)], name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    "payment_transactions": [
+        IndexModel([("session_id", ASCENDING)], name="session_id_unique", unique=True),
+        IndexModel([("booking_id", ASCENDING)], name="booking_id"),
+        IndexModel([("created_at", ASCENDING)], name="created_at"),
+    ],
+    "reviews": [
+        IndexModel([("is_approved", ASCENDING), ("created_at", DESCENDING)], name="approved_created_at"),
+    ],
+    "contact_messages": [
+        IndexModel([("created_at", DESCENDING)], name="created_at_desc"),
+    ],
+    "daily_stats": [
+        IndexModel([("date", ASCENDING), ("room_id", ASCENDING)], name="date_room_unique", unique=True),
+    ],
+    "email_outbox": [
+        IndexModel([("status", ASCENDING), ("next_attempt_at", ASCENDING)], name="status_next_attempt"),
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        # Le email inviate (con l'HTML e i dati dell'ospite) vengono eliminate da Mongo dopo 30 giorni
+        IndexModel([("sent_at", ASCENDING)], name="sent_at_ttl", expireAfterSeconds=30 * 86400,
+                   partialFilterExpression={"status": "sent"}),
+    ],
+    "ical_feeds": [
+        IndexModel([("room_id", ASCENDING)], name="room_id_unique", unique=True),
+    ],
+    "occupancy_versions": [
+        IndexModel([("room_id", ASCENDING)], name="room_id_unique", unique=True),
+    ],
+    "calendar_export_versions": [
+        IndexModel([("room_id", ASCENDING)], name="room_id_unique", unique=True),
+    ],
+    "stripe_events": [
+        IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+        # Stripe riprova la consegna per al massimo 3 giorni: oltre non serve ricordare l'evento
+        IndexModel([("received_at", ASCENDING)], name="received_at_ttl", expireAfterSeconds=30 * 86400),
+    ],
+}
+
+async def ensure_indexes():
+    """Crea gli indici mancanti; un errore su un indice (es. duplicati esistenti) non blocca
+    gli altri, mentre se Mongo non è raggiungibile si interrompe subito"""
+    for collection, indexes in INDEXES.items():
+        for index in indexes:
+            try:
+                await db[collection].create_indexes([index])
+            except ServerSelectionTimeoutError:
+                raise
+            except Exception as e:
+                logger.error(f"Index {collection}.{index.document['name']} not created: {e}")
+
+STARTUP_RETRY_SECONDS = 60
+
+async def startup_maintenance():
+    """Operazioni di avvio sul database, in ordine. Se Mongo non risponde si riprova più tardi;
+    nel frattempo indice delle occupazioni e cataloghi si caricano alla prima richiesta."""
+    while True:
+        try:
+            # Le migrazioni precedono gli indici (es. dedupe prima dell'indice unique)
+            for migration in (migrate_blocked_dates, dedupe_ical_imports, backfill_stats_totals):
+                try:
+                    await migration()
+                except ServerSelectionTimeoutError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Startup migration {migration.__name__} failed: {e}")
+            await ensure_indexes()
+            break
+        except ServerSelectionTimeoutError as e:
+            logger.error(f"MongoDB unreachable at startup, retrying in {STARTUP_RETRY_SECONDS}s: {e}")
+            await asyncio.sleep(STARTUP_RETRY_SECONDS)
     try:
-        msg = MIMEMultipart()
-        msg['From'] = SENDER_EMAIL
-        msg['To'] = to_email
-        msg['Subject'] = subject
-        msg.attach(MIMEText(html_content, 'html'))
-
-        logger.info(f"Connecting to SMTP: {SMTP_HOST}:{SMTP_PORT}")
-        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT)
-        server.starttls()
-        server.login(SMTP_USER, SMTP_PASSWORD)
-        server.send_message(msg)
-        server.quit()
-        logger.info(f"EMAIL SENT SUCCESSFULLY to {to_email}")
-        return True
+        await normalize_booking_timestamps()
     except Exception as e:
-        logger.error(f"EMAIL ERROR to {to_email}: {str(e)}")
-        return False
+        logger.error(f"Booking timestamps normalization failed: {e}")
+    try:
+        await occupancy_index.rebuild()
+    except Exception as e:
+        # Il primo /availability riproverà a costruire l'indice
+        logger.error(f"Occupancy index build failed: {e}")
+    try:
+        await room_catalog.load()
+        await upsell_catalog.load()
+    except Exception as e:
+        # Verranno caricati alla prima richiesta
+        logger.error(f"Catalog load failed: {e}")
+
+@api_router.get("/admin/index-stats", dependencies=[Depends(require_admin)])
+async def get_index_stats():
+    """Statistiche d'uso degli indici ($indexStats) per ogni collezione del registro"""
+    result = {}
+    for collection, indexes in INDEXES.items():
+        stats = await db[collection].aggregate([{"$indexStats": {}}]).to_list(None)
+        present = {st["name"] for st in stats}
+        result[collection] = {
+            "indexes": [
+                {
+                    "name": st["name"],
+                    "key": st["key"],
+                    "ops": st.get("accesses", {}).get("ops", 0),
+                    "since": st.get("accesses", {}).get("since")
+                }
+                for st in stats
+            ],
+            "missing": [i.document["name"] for i in indexes if i.document["name"] not in present]
+        }
+    return result
 
-def send_booking_confirmation_task(booking: dict, room_name: str):
-    subject = "Conferma Prenotazione - Desideri di Puglia"
-    html = f"""
-    <h1>Grazie {booking['guest_name']}!</h1>
-    <p>La tua prenotazione per <strong>{room_name}</strong> è confermata.</p>
-    <p><strong>Check-in:</strong> {booking['check_in']}</p>
-    <p><strong>Check-out:</strong> {booking['check_out']}</p>
-    <p><strong>Ospiti:</strong> {booking['num_guests']}</p>
-    <p><strong>Prezzo Totale:</strong> €{booking['total_price']}</p>
-    <br>
-    <p>A presto,<br>Desideri di Puglia</p>
-    <hr>
-    <small>Questa è una mail automatica.</small>
-    """
-    _send_email_sync(booking["guest_email"], subject, html)
+# ==================== EMAIL LOGIC ====================
+# Le email non vengono più inviate dentro le richieste: gli handler le accodano in
+# email_outbox e un worker in background le spedisce a lotti riusando una sola
+# connessione SMTP autenticata, con retry e backoff in caso di errore.
+
+OUTBOX_BATCH = 20
+OUTBOX_POLL_SECONDS = 30
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_LEASE_SECONDS = 300
+SMTP_IDLE_CLOSE_SECONDS = 60
+
+outbox_wakeup = asyncio.Event()
+
+class SMTPMailer:
+    """Connessione SMTP persistente (STARTTLS + login una sola volta), riaperta se cade"""
+
+    def __init__(self, host: str, port: int, user: Optional[str], password: Optional[str], starttls: bool = True):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.starttls = starttls
+        self._server: Optional[smtplib.SMTP] = None
+
+    def _connect(self):
+        logger.info(f"Connecting to SMTP: {self.host}:{self.port}")
+        server = smtplib.SMTP(self.host, self.port, timeout=30)
+        if self.starttls:
+            server.starttls()
+        if self.password:
+            server.login(self.user, self.password)
+        self._server = server
+
+    def close(self):
+        if self._server:
+            try:
+                self._server.quit()
+            except Exception:
+                pass
+            self._server = None
+
+    def send(self, msg: MIMEMultipart):
+        if self._server is None:
+            self._connect()
+        try:
+            self._server.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # Il server ha chiuso la connessione inattiva: una riconnessione e un secondo tentativo
+            self._server = None
+            self._connect()
+            self._server.send_message(msg)
+
+    @staticmethod
+    def _is_connection_error(e: Exception) -> bool:
+        # SMTPException deriva da OSError: gli errori del singolo messaggio non contano
+        if isinstance(e, (smtplib.SMTPConnectError, smtplib.SMTPServerDisconnected, smtplib.SMTPAuthenticationError)):
+            return True
+        return isinstance(e, OSError) and not isinstance(e, smtplib.SMTPException)
+
+    def send_batch(self, messages: List[tuple]) -> List[Optional[str]]:
+        """Invia (id, MIME) in sequenza sulla stessa connessione; restituisce l'errore per messaggio o None.
+
+        Al primo errore di connessione il lotto si interrompe: la lista restituita è più corta
+        e i messaggi restanti non sono stati tentati (ogni connect può attendere fino a 30 s).
+        """
+        results = []
+        for _, msg in messages:
+            try:
+                self.send(msg)
+                results.append(None)
+            except Exception as e:
+                logger.error(f"EMAIL ERROR to {msg['To']}: {str(e)}")
+                if not isinstance(e, smtplib.SMTPRecipientsRefused):
+                    self.close()
+                results.append(str(e))
+                if self._is_connection_error(e):
+                    break
+        return results
+
+mailer = SMTPMailer(SMTP_HOST, SMTP_PORT, SMTP_USER, SMTP_PASSWORD, starttls=SMTP_STARTTLS)
+
+def _build_message(to_email: str, subject: str, html_content: str) -> MIMEMultipart:
+    msg = MIMEMultipart()
+    msg['From'] = SENDER_EMAIL
+    msg['To'] = to_email
+    msg['Subject'] = subject
+    msg.attach(MIMEText(html_content, 'html'))
+    return msg
+
+async def enqueue_email(to_email: str, subject: str, html_content: str):
+    """Accoda una email in email_outbox: l'handler ritorna subito, l'invio lo fa il worker"""
+    if not SMTP_USER:
+        logger.error("Credenziali email mancanti - Controlla Environment Variables su Render")
+        return
+    now = datetime.now(timezone.utc)
+    await db.email_outbox.insert_one({
+        "id": str(uuid.uuid4()),
+        "to": to_email,
+        "subject": subject,
+        "html": html_content,
+        "status": "pending",
+        "attempts": 0,
+        "next_attempt_at": now,
+        "created_at": now
+    })
+    outbox_wakeup.set()
+
+async def _claim_outbox_batch() -> List[dict]:
+    now = datetime.now(timezone.utc)
+    batch = []
+    while len(batch) < OUTBOX_BATCH:
+        doc = await db.email_outbox.find_one_and_update(
+            {"$or": [
+                {"status": "pending", "next_attempt_at": {"$lte": now}},
+                # Lotti rimasti a metà per un worker caduto
+                {"status": "sending", "lease_until": {"$lte": now}}
+            ]},
+            {"$set": {"status": "sending", "lease_until": now + timedelta(seconds=OUTBOX_LEASE_SECONDS)}},
+            sort=[("next_attempt_at", ASCENDING)],
+            projection={"_id": 0}, return_document=ReturnDocument.AFTER
+        )
+        if not doc:
+            break
+        batch.append(doc)
+    return batch
+
+async def process_outbox_batch() -> int:
+    """Invia un lotto di email in attesa; restituisce quante ne ha prese in carico"""
+    batch = await _claim_outbox_batch()
+    if not batch:
+        return 0
+    messages = [(doc["id"], _build_message(doc["to"], doc["subject"], doc["html"])) for doc in batch]
+    results = await asyncio.to_thread(mailer.send_batch, messages)
+
+    now = datetime.now(timezone.utc)
+    ops = []
+    # Messaggi non tentati per un errore di connessione: tornano in coda senza contare un tentativo
+    untouched = [doc["id"] for doc in batch[len(results):]]
+    if untouched:
+        ops.append(UpdateMany({"id": {"$in": untouched}, "status": "sending"},
+                              {"$set": {"status": "pending", "next_attempt_at": now + timedelta(seconds=60)},
+                               "$unset": {"lease_until": ""}}))
+    for doc, error in zip(batch, results):
+        if error is None:
+            ops.append(UpdateOne({"id": doc["id"]}, {"$set": {"status": "sent", "sent_at": now, "last_error": None},
+                                                     "$unset": {"lease_until": ""}}))
+            logger.info(f"EMAIL SENT SUCCESSFULLY to {doc['to']}")
+            continue
+        attempts = doc.get("attempts", 0) + 1
+        update = {"attempts": attempts, "last_error": error}
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            update["status"] = "failed"
+        else:
+            update["status"] = "pending"
+            update["next_attempt_at"] = now + timedelta(seconds=min(60 * 2 ** attempts, 3600))
+        ops.append(UpdateOne({"id": doc["id"]}, {"$set": update, "$unset": {"lease_until": ""}}))
+    await db.email_outbox.bulk_write(ops, ordered=False)
+    return len(batch)
+
+async def email_outbox_worker():
+    idle_since = time.monotonic()
+    while True:
+        try:
+            if await process_outbox_batch():
+                idle_since = time.monotonic()
+                continue
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Email outbox error: {e}")
+        if time.monotonic() - idle_since > SMTP_IDLE_CLOSE_SECONDS:
+            await asyncio.to_thread(mailer.close)
+        outbox_wakeup.clear()
+        try:
+            await asyncio.wait_for(outbox_wakeup.wait(), timeout=OUTBOX_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+# --- TEMPLATE EMAIL ---
+# Template Jinja2 in email_templates/<nome>.<lingua>.html, compilati una volta all'avvio.
+# L'autoescape è attivo sugli .html: i dati inseriti dagli ospiti non possono iniettare markup.
+
+EMAIL_TEMPLATES_DIR = ROOT_DIR / "email_templates"
+EMAIL_LANGUAGES = ("it", "en")
+EMAIL_SUBJECTS = {
+    ("booking_confirmation", "it"): "Conferma Prenotazione - Desideri di Puglia",
+    ("booking_confirmation", "en"): "Booking Confirmation - Desideri di Puglia",
+    ("booking_admin", "it"): "Nuova prenotazione: {{ booking.guest_name }}",
+    ("booking_admin", "en"): "New booking: {{ booking.guest_name }}",
+    ("contact_notification", "it"): "Nuovo messaggio da {{ contact.name }}",
+    ("contact_notification", "en"): "New message from {{ contact.name }}",
+}
+# Dati di esempio per l'anteprima dall'admin
+EMAIL_PREVIEW_CONTEXT = {
+    "booking": {"guest_name": "Mario Rossi", "guest_email": "mario@example.com", "check_in": "2025-07-10",
+                "check_out": "2025-07-14", "num_guests": 2, "total_price": 320.0},
+    "room_name": "Stanza della Nonna",
+    "contact": {"name": "Mario Rossi", "email": "mario@example.com", "message": "Buongiorno,\n<b>è disponibile</b> ad agosto?"},
+}
+
+email_env = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(str(EMAIL_TEMPLATES_DIR)),
+    autoescape=jinja2.select_autoescape(enabled_extensions=("html",), default_for_string=False),
+    auto_reload=False
+)
+# (nome, lingua) -> (template oggetto, template corpo)
+email_templates: Dict[tuple, tuple] = {}
+
+def load_email_templates():
+    """Compila tutti i template (oggetto e corpo) nella cache in memoria"""
+    email_templates.clear()
+    for (name, lang), subject in EMAIL_SUBJECTS.items():
+        email_templates[(name, lang)] = (
+            email_env.from_string(subject),
+            email_env.get_template(f"{name}.{lang}.html")
+        )
+    logger.info(f"Email templates loaded: {len(email_templates)}")
+
+def render_email(name: str, language: Optional[str], **context) -> tuple:
+    """(oggetto, html) del template nella lingua richiesta, con fallback sull'italiano"""
+    if not email_templates:
+        load_email_templates()
+    lang = language if language in EMAIL_LANGUAGES else "it"
+    subject_tpl, body_tpl = email_templates.get((name, lang)) or email_templates[(name, "it")]
+    return subject_tpl.render(**context), body_tpl.render(**context)
+
+async def send_booking_confirmation_task(booking: dict, room: dict):
+    language = booking.get("language", "it")
+    room_name = room.get(f"name_{language}") or room.get("name_it", "")
+    subject, html = render_email("booking_confirmation", language, booking=booking, room_name=room_name)
+    await enqueue_email(booking["guest_email"], subject, html)
     
-    admin_subject = f"Nuova prenotazione: {booking['guest_name']}"
-    admin_html = f"<p>Nuova prenotazione ricevuta per {room_name}.</p><p>Totale: €{booking['total_price']}</p>"
-    _send_email_sync(SMTP_USER, admin_subject, admin_html)
+    admin_subject, admin_html = render_email("booking_admin", "it", booking=booking, room_name=room.get("name_it", ""))
+    await enqueue_email(SMTP_USER, admin_subject, admin_html)
 
 async def send_contact_notification(contact: ContactMessage):
-    subject = f"Nuovo messaggio da {contact.name}"
-    html = f"""
-    <h3>Nuovo messaggio dal sito</h3>
-    <p><strong>Nome:</strong> {contact.name}</p>
-    <p><strong>Email:</strong> {contact.email}</p>
-    <p><strong>Messaggio:</strong><br>{contact.message}</p>
+    subject, html = render_email("contact_notification", contact.language, contact=contact.model_dump())
+    await enqueue_email(SMTP_USER, subject, html)
+
+@api_router.get("/admin/email-templates/{name}/preview", dependencies=[Depends(require_admin)])
+async def preview_email_template(name: str, language: str = "it"):
+    if (name, "it") not in EMAIL_SUBJECTS:
+        raise HTTPException(404, "Template not found")
+    subject, html = render_email(name, language, **EMAIL_PREVIEW_CONTEXT)
+    return HTMLResponse(content=html, headers={"X-Email-Subject": quote(subject)})
+
+# ==================== PAYMENTS ====================
+
+class PaymentGateway:
+    """Client Stripe asincrono: le chiamate girano sull'event loop tramite httpx
+    (connessioni riusate), con timeout, retry e chiavi di idempotenza.
+    Il client viene creato al primo uso, così l'app parte anche senza chiave"""
+
+    def __init__(self, api_key: Optional[str], api_base: str, timeout: float, max_retries: int):
+        self.api_key = api_key
+        self.api_base = api_base.rstrip('/')
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self._http = None
+        self._client = None
+
+    def _get_client(self):
+        if self._client is None:
+            if not self.api_key:
+                raise RuntimeError("STRIPE_SECRET_KEY not configured")
+            self._http = stripe.HTTPXClient(timeout=self.timeout)
+            self._client = stripe.StripeClient(
+                self.api_key,
+                http_client=self._http,
+                base_addresses={"api": self.api_base},
+                max_network_retries=self.max_retries
+            )
+        return self._client
+
+    async def create_checkout_session(self, params: dict, idempotency_key: str):
+        # Stessa chiave sui retry: Stripe non crea una seconda sessione per la stessa prenotazione
+        return await self._get_client().v1.checkout.sessions.create_async(
+            params=params, options={"idempotency_key": idempotency_key}
+        )
+
+    async def retrieve_checkout_session(self, session_id: str):
+        return await self._get_client().v1.checkout.sessions.retrieve_async(session_id)
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.close_async()
+            self._http = None
+            self._client = None
+
+payment_gateway = PaymentGateway(STRIPE_SECRET_KEY, STRIPE_API_BASE, STRIPE_TIMEOUT, STRIPE_MAX_RETRIES)
+
+# ==================== ROOM CATALOG ====================
+# Le camere cambiano raramente (update_room) ma sono le pagine più richieste: il
+# catalogo resta in memoria con il JSON già serializzato e un ETag di versione.
+# update_room lo ricarica subito; gli altri worker si riallineano entro il TTL.
+
+ROOM_CATALOG_TTL = 300
+
+class RoomCatalog:
+    def __init__(self):
+        self.rooms: Dict[str, dict] = {}
+        self._list_body = b"[]"
+        self._bodies: Dict[str, bytes] = {}
+        self.etag = ""
+        self._etags: Dict[str, str] = {}
+        self.last_modified = datetime.now(timezone.utc)
+        self._loaded_at: Optional[float] = None
+        self._lock = asyncio.Lock()
+
+    async def load(self):
+        docs = await db.rooms.find({}, {"_id": 0}).to_list(100)
+        # jsonable_encoder come FastAPI: le date restano in formato ISO
+        docs = jsonable_encoder(docs)
+        self._list_body = json.dumps(docs).encode()
+        # ETag dal contenuto: uguale su tutti i worker per la stessa versione
+        self.etag = f'"rooms-{hashlib.sha256(self._list_body).hexdigest()[:16]}"'
+        self._bodies, self._etags = {}, {}
+        for doc in docs:
+            body = json.dumps(doc).encode()
+            self._bodies[doc["id"]] = body
+            self._etags[doc["id"]] = f'"room-{hashlib.sha256(body).hexdigest()[:16]}"'
+        self.rooms = {doc["id"]: doc for doc in docs}
+        self.last_modified = datetime.now(timezone.utc).replace(microsecond=0)
+        self._loaded_at = time.monotonic()
+        logger.info(f"Room catalog loaded: {len(docs)} rooms")
+
+    async def ensure_fresh(self):
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > ROOM_CATALOG_TTL:
+            async with self._lock:
+                if self._loaded_at is None or time.monotonic() - self._loaded_at > ROOM_CATALOG_TTL:
+                    await self.load()
+
+    async def get(self, room_id: str) -> Optional[dict]:
+        await self.ensure_fresh()
+        return self.rooms.get(room_id)
+
+    def _response(self, request: Request, body: bytes, etag: str) -> Response:
+        headers = {
+            "ETag": etag,
+            "Last-Modified": format_datetime(self.last_modified, usegmt=True),
+            "Cache-Control": "no-cache"
+        }
+        if _not_modified(request, etag, self.last_modified):
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    async def list_response(self, request: Request) -> Response:
+        await self.ensure_fresh()
+        return self._response(request, self._list_body, self.etag)
+
+    async def room_response(self, request: Request, room_id: str) -> Optional[Response]:
+        await self.ensure_fresh()
+        if room_id not in self._bodies:
+            return None
+        return self._response(request, self._bodies[room_id], self._etags[room_id])
+
+room_catalog = RoomCatalog()
+
+def _not_modified(request: Request, etag: str, last_modified: datetime) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        return etag in [t.strip() for t in if_none_match.split(",")] or if_none_match.strip() == "*"
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return last_modified <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+# ==================== UPSELL CATALOG ====================
+# Tabella piccola e quasi statica: in memoria, ordinata per "order", con versione
+# (hash del contenuto) e un pre-indice per soglia di notti. Le route di scrittura
+# la ricaricano subito; gli altri worker si riallineano entro il TTL.
+
+UPSELL_CATALOG_TTL = 300
+
+class UpsellCatalog:
+    def __init__(self):
+        self.upsells: List[dict] = []
+        self.by_id: Dict[str, dict] = {}
+        self.version = ""
+        self.last_modified = datetime.now(timezone.utc)
+        # Soglie min_nights distinte (crescenti) e, per ciascuna, gli upsell attivi idonei
+        self._thresholds: List[int] = []
+        self._eligible: List[List[dict]] = []
+        self._loaded_at: Optional[float] = None
+        self._lock = asyncio.Lock()
+
+    async def load(self):
+        docs = jsonable_encoder(await db.upsells.find({}, {"_id": 0}).sort("order", 1).to_list(None))
+        self.upsells = docs
+        self.by_id = {u["id"]: u for u in docs}
+        active = [u for u in docs if u.get("is_active", True)]
+        self._thresholds = sorted({int(u.get("min_nights") or 0) for u in active})
+        self._eligible = [[u for u in active if int(u.get("min_nights") or 0) <= t] for t in self._thresholds]
+        body = json.dumps(docs, sort_keys=True).encode()
+        self.version = f'"upsells-{hashlib.sha256(body).hexdigest()[:16]}"'
+        self.last_modified = datetime.now(timezone.utc).replace(microsecond=0)
+        self._loaded_at = time.monotonic()
+
+    async def ensure_fresh(self):
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > UPSELL_CATALOG_TTL:
+            async with self._lock:
+                if self._loaded_at is None or time.monotonic() - self._loaded_at > UPSELL_CATALOG_TTL:
+                    await self.load()
+
+    def eligible(self, nights: int) -> List[dict]:
+        """Upsell attivi acquistabili per un soggiorno di `nights` notti"""
+        i = bisect.bisect_right(self._thresholds, nights)
+        return self._eligible[i - 1] if i else []
+
+upsell_catalog = UpsellCatalog()
+
+# ==================== OCCUPANCY INDEX ====================
+
+OCCUPYING_STATUSES = ("pending", "confirmed")
+
+def _day_ordinal(date_str: str) -> int:
+    return date.fromisoformat(date_str).toordinal()
+
+# Ogni scrittura che cambia le occupazioni di una stanza incrementa la sua versione
+# in occupancy_versions; prima di rispondere un worker confronta (al più ogni
+# OCCUPANCY_CHECK_SECONDS) la propria versione e, se è indietro, rilegge la stanza.
+OCCUPANCY_CHECK_SECONDS = 5
+
+class OccupancyIndex:
+    """Mappa di processo delle notti occupate per stanza, indicizzate per ordinale del giorno.
+
+    Ogni intervallo occupante (prenotazione o blocco) è registrato con l'id del
+    documento, così cambi di stato e cancellazioni rilasciano esattamente le notti
+    che teneva. Ogni notte ha un contatore di riferimenti, quindi gli intervalli
+    sovrapposti (es. un import iCal sopra un blocco manuale) sono gestiti.
+    """
+
+    def __init__(self):
+        self._nights: Dict[str, Dict[int, int]] = {}
+        self._intervals: Dict[str, tuple] = {}
+        self._versions: Dict[str, int] = {}
+        self._checked_at: Dict[str, float] = {}
+        self.ready = False
+
+    def _add(self, key: str, room_id: str, start: int, end: int):
+        self._discard(key)
+        if end <= start:
+            return
+        self._intervals[key] = (room_id, start, end)
+        nights = self._nights.setdefault(room_id, {})
+        for day in range(start, end):
+            nights[day] = nights.get(day, 0) + 1
+
+    def _discard(self, key: str):
+        interval = self._intervals.pop(key, None)
+        if not interval:
+            return
+        room_id, start, end = interval
+        nights = self._nights.get(room_id, {})
+        for day in range(start, end):
+            left = nights.get(day, 0) - 1
+            if left > 0:
+                nights[day] = left
+            else:
+                nights.pop(day, None)
+
+    def apply_booking(self, booking: dict):
+        """Registra o rilascia le notti di una prenotazione in base allo stato"""
+        key = f"booking:{booking['id']}"
+        if booking.get("status") not in OCCUPYING_STATUSES:
+            self._discard(key)
+            return
+        try:
+            start = _day_ordinal(booking["check_in"])
+            end = _day_ordinal(booking["check_out"])
+        except (KeyError, TypeError, ValueError):
+            self._discard(key)
+            return
+        self._add(key, booking["room_id"], start, end)
+
+    def apply_blocked(self, blocked: dict):
+        self._add(f"blocked:{blocked['id']}", blocked["room_id"],
+                  _day_ordinal(blocked["start"]), _day_ordinal(blocked["end"]))
+
+    def remove_blocked(self, blocked_id: str):
+        self._discard(f"blocked:{blocked_id}")
+
+    def _clear_room(self, room_id: str):
+        for key in [k for k, v in self._intervals.items() if v[0] == room_id]:
+            del self._intervals[key]
+        self._nights.pop(room_id, None)
+
+    async def reload_room(self, room_id: str):
+        """Rilegge da Mongo le occupazioni di una sola stanza (usato dopo il sync iCal)"""
+        bookings = await db.bookings.find(
+            {"room_id": room_id, "status": {"$in": list(OCCUPYING_STATUSES)}},
+            {"_id": 0, "id": 1, "room_id": 1, "status": 1, "check_in": 1, "check_out": 1}
+        ).to_list(None)
+        blocked = await db.blocked_dates.find({"room_id": room_id}, {"_id": 0}).to_list(None)
+        self._clear_room(room_id)
+        for b in bookings:
+            self.apply_booking(b)
+        for blk in blocked:
+            self.apply_blocked(blk)
+
+    async def bump(self, room_id: str):
+        """Da chiamare dopo aver applicato localmente una scrittura: la rende visibile agli altri worker"""
+        doc = await db.occupancy_versions.find_one_and_update(
+            {"room_id": room_id}, {"$inc": {"version": 1}, "$set": {"updated_at": datetime.now(timezone.utc)}},
+            projection={"_id": 0, "version": 1}, upsert=True, return_document=ReturnDocument.AFTER
+        )
+        if doc["version"] == self._versions.get(room_id, 0) + 1:
+            self._versions[room_id] = doc["version"]
+        else:
+            # Nel frattempo ha scritto un altro worker: la prossima lettura ricarica la stanza
+            self._checked_at.pop(room_id, None)
+
+    async def ensure_fresh(self, room_id: str):
+        """Ricarica la stanza se un altro worker l'ha modificata dopo l'ultima lettura"""
+        if not self.ready:
+            await self.rebuild()
+            return
+        now = time.monotonic()
+        if now - self._checked_at.get(room_id, 0) < OCCUPANCY_CHECK_SECONDS:
+            return
+        self._checked_at[room_id] = now
+        doc = await db.occupancy_versions.find_one({"room_id": room_id}, {"_id": 0, "version": 1})
+        version = doc["version"] if doc else 0
+        if version != self._versions.get(room_id, 0):
+            await self.reload_room(room_id)
+            self._versions[room_id] = version
+
+    async def rebuild(self):
+        """Costruisce l'indice da zero leggendo tutte le occupazioni attive"""
+        # Versioni lette prima dei dati: una scrittura concorrente risulterà comunque più recente
+        versions = await db.occupancy_versions.find({}, {"_id": 0}).to_list(None)
+        bookings = await db.bookings.find(
+            {"status": {"$in": list(OCCUPYING_STATUSES)}},
+            {"_id": 0, "id": 1, "room_id": 1, "status": 1, "check_in": 1, "check_out": 1}
+        ).to_list(None)
+        blocked = await db.blocked_dates.find({}, {"_id": 0}).to_list(None)
+        self._nights = {}
+        self._intervals = {}
+        for b in bookings:
+            self.apply_booking(b)
+        for blk in blocked:
+            self.apply_blocked(blk)
+        self._versions = {v["room_id"]: v["version"] for v in versions}
+        now = time.monotonic()
+        self._checked_at = {room_id: now for room_id in self._versions}
+        self.ready = True
+        logger.info(f"Occupancy index built: {len(self._intervals)} intervals")
+
+    def unavailable_dates(self, room_id: str, start_date: str, end_date: str) -> List[str]:
+        """Notti occupate nella finestra [start_date, end_date], estremi inclusi"""
+        nights = self._nights.get(room_id)
+        if not nights:
+            return []
+        start = _day_ordinal(start_date)
+        end = _day_ordinal(end_date)
+        if end - start + 1 > len(nights):
+            days = sorted(d for d in nights if start <= d <= end)
+        else:
+            days = [d for d in range(start, end + 1) if d in nights]
+        return [date.fromordinal(d).isoformat() for d in days]
+
+occupancy_index = OccupancyIndex()
+
+# ==================== PRICING ====================
+
+def price_stay(check_in: str, check_out: str, default_price: float, custom_prices: Dict[str, float],
+               upsells: Dict[str, dict], upsell_ids: Optional[List[str]] = None, coupon: Optional[dict] = None) -> dict:
+    """Calcolo puro del prezzo di un soggiorno, senza accessi al database.
+
+    `custom_prices` mappa data -> prezzo per le notti del soggiorno, `upsells`
+    mappa id -> upsell attivo. Gli id non presenti in `upsells` vengono ignorati.
     """
-    return await asyncio.to_thread(_send_email_sync, SMTP_USER, subject, html)
+    start = date.fromisoformat(check_in)
+    nights = (date.fromisoformat(check_out) - start).days
+
+    breakdown = []
+    room_price = 0.0
+    for i in range(nights):
+        date_str = (start + timedelta(days=i)).isoformat()
+        custom = custom_prices.get(date_str)
+        price = float(custom) if custom is not None else default_price
+        breakdown.append({"date": date_str, "price": price, "custom": custom is not None})
+        room_price += price
+
+    upsells_total = 0.0
+    selected = []
+    for uid in upsell_ids or []:
+        upsell = upsells.get(uid)
+        if upsell:
+            upsells_total += float(upsell["price"])
+            selected.append(uid)
+
+    discount_amount = 0.0
+    coupon_code = None
+    if coupon and coupon.get("is_active"):
+        coupon_code = coupon["code"]
+        if coupon["discount_type"] == "percentage":
+            discount_amount = room_price * (coupon["discount_value"]/100)
+        else:
+            discount_amount = min(coupon["discount_value"], room_price)
+
+    subtotal = room_price + upsells_total
+    return {
+        "nights": nights,
+        "breakdown": breakdown,
+        "room_price": room_price,
+        "upsells": selected,
+        "upsells_total": upsells_total,
+        "subtotal": subtotal,
+        "coupon_code": coupon_code,
+        "discount_amount": discount_amount,
+        "total_price": subtotal - discount_amount
+    }
+
+async def quote_stay(room: dict, check_in: str, check_out: str,
+                     upsell_ids: Optional[List[str]] = None, coupon_code: Optional[str] = None) -> dict:
+    """Carica prezzi personalizzati e coupon (in parallelo), prende gli upsell dal catalogo e calcola il prezzo"""
+    try:
+        nights = (date.fromisoformat(check_out) - date.fromisoformat(check_in)).days
+    except ValueError:
+        raise HTTPException(400, "Formato data non valido (YYYY-MM-DD)")
+    if nights <= 0:
+        raise HTTPException(400, "Check-out must be after check-in")
+
+    async def _no_result():
+        return None
+
+    custom_q = db.custom_prices.find(
+        {"room_id": room["id"], "date": {"$gte": check_in, "$lt": check_out}},
+        {"_id": 0, "date": 1, "price": 1}
+    ).to_list(None)
+    coupon_q = db.coupons.find_one({"code": coupon_code.upper()}, {"_id": 0}) if coupon_code else _no_result()
+    custom, coupon, _ = await asyncio.gather(custom_q, coupon_q, upsell_catalog.ensure_fresh())
+
+    # Solo gli upsell idonei per la durata del soggiorno: gli altri vengono ignorati
+    upsells = {u["id"]: u for u in upsell_catalog.eligible(nights)} if upsell_ids else {}
+
+    return price_stay(
+        check_in, check_out, float(room["price_per_night"]),
+        {cp["date"]: cp["price"] for cp in custom},
+        upsells,
+        upsell_ids, coupon
+    )
+
+# Preventivi memoizzati per (stanza, date, upsell, coupon). Vengono svuotati a ogni
+# modifica di prezzi, upsell o coupon; il TTL limita il disallineamento tra worker.
+quote_cache = LRUCache(maxsize=512, ttl=300)
+
+def invalidate_quotes():
+    quote_cache.clear()
+
+# ==================== DAILY STATS ====================
+# daily_stats: un documento per (date, room_id) con check_ins, check_outs, nights_sold,
+# revenue (prenotazioni confermate, per giorno di prenotazione) e pending (per giorno di
+# creazione). Viene aggiornato con $inc a ogni transizione di una prenotazione.
+# Il documento con date=STATS_TOTALS_DAY tiene per stanza il totale corrente delle
+# pending, così il conteggio non richiede di scorrere tutto lo storico.
+
+STATS_TOTALS_DAY = "totals"
+
+def _created_day(booking: dict) -> str:
+    created_at = booking.get("created_at")
+    if isinstance(created_at, datetime):
+        return created_at.date().isoformat()
+    if isinstance(created_at, str) and len(created_at) >= 10:
+        return created_at[:10]
+    return date.today().isoformat()
+
+def _booking_stat_deltas(booking: dict, sign: int, deltas: Dict[tuple, Dict[str, float]]):
+    """Aggiunge a `deltas` il contributo (con segno) di una prenotazione alle statistiche giornaliere"""
+    room_id = booking["room_id"]
+
+    def inc(day: str, field: str, value: float):
+        fields = deltas.setdefault((day, room_id), {})
+        fields[field] = fields.get(field, 0) + value
+
+    status = booking.get("status")
+    if status == "pending":
+        inc(_created_day(booking), "pending", sign)
+        inc(STATS_TOTALS_DAY, "pending", sign)
+    elif status == "confirmed":
+        try:
+            start = date.fromisoformat(booking["check_in"])
+            end = date.fromisoformat(booking["check_out"])
+        except (KeyError, TypeError, ValueError):
+            return
+        inc(booking["check_in"], "check_ins", sign)
+        inc(booking["check_out"], "check_outs", sign)
+        for i in range((end - start).days):
+            inc((start + timedelta(days=i)).isoformat(), "nights_sold", sign)
+        inc(_created_day(booking), "revenue", sign * float(booking.get("total_price") or 0))
+
+async def apply_stat_deltas(deltas: Dict[tuple, Dict[str, float]]):
+    ops = []
+    for (day, room_id), fields in deltas.items():
+        fields = {k: v for k, v in fields.items() if v}
+        if fields:
+            ops.append(UpdateOne({"date": day, "room_id": room_id}, {"$inc": fields}, upsert=True))
+    if ops:
+        await db.daily_stats.bulk_write(ops, ordered=False)
+
+async def record_booking_transition(before: Optional[dict], after: Optional[dict]):
+    """Aggiorna daily_stats per il passaggio di una prenotazione da `before` ad `after` (None = assente)"""
+    deltas = {}
+    if before:
+        _booking_stat_deltas(before, -1, deltas)
+    if after:
+        _booking_stat_deltas(after, 1, deltas)
+    try:
+        await apply_stat_deltas(deltas)
+    except Exception as e:
+        logger.error(f"Daily stats update failed: {e}")
+
+async def rebuild_daily_stats() -> int:
+    """Ricalcola daily_stats da zero scorrendo tutte le prenotazioni (per backfill)"""
+    deltas = {}
+    async for booking in db.bookings.find({"status": {"$in": ["pending", "confirmed"]}}, {"_id": 0}):
+        _booking_stat_deltas(booking, 1, deltas)
+    ops = [DeleteMany({})]
+    for (day, room_id), fields in deltas.items():
+        doc = {"date": day, "room_id": room_id, "check_ins": 0, "check_outs": 0, "nights_sold": 0, "revenue": 0.0, "pending": 0}
+        doc.update(fields)
+        ops.append(InsertOne(doc))
+    await db.daily_stats.bulk_write(ops, ordered=True)
+    logger.info(f"Daily stats rebuilt: {len(ops) - 1} documents")
+    return len(ops) - 1
+
+async def backfill_stats_totals():
+    """Crea una sola volta i totali per stanza dai documenti giornalieri già esistenti"""
+    if await db.daily_stats.find_one({"date": STATS_TOTALS_DAY}):
+        return
+    rows = await db.daily_stats.aggregate([
+        {"$group": {"_id": "$room_id", "pending": {"$sum": "$pending"}}}
+    ]).to_list(None)
+    ops = [UpdateOne({"date": STATS_TOTALS_DAY, "room_id": r["_id"]}, {"$set": {"pending": r["pending"]}}, upsert=True)
+           for r in rows if r["_id"]]
+    if ops:
+        await db.daily_stats.bulk_write(ops, ordered=False)
+
+@api_router.post("/admin/daily-stats/rebuild", dependencies=[Depends(require_admin)])
+async def rebuild_daily_stats_endpoint():
+    count = await rebuild_daily_stats()
+    return {"message": f"Daily stats rebuilt ({count} documents)"}
 
 # ==================== ICAL CALENDAR LOGIC (SYNC FIX) ====================
 
+ICAL_FETCH_TIMEOUT = 10  # secondi, per singolo feed
+ICAL_SYNC_ENABLED = os.environ.get('ICAL_SYNC_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+ICAL_SYNC_INTERVAL = int(os.environ.get('ICAL_SYNC_INTERVAL_MINUTES', 30)) * 60
+ICAL_SYNC_MAX_BACKOFF = 6 * 3600
+ICAL_SYNC_TICK = 60
+ICAL_LEASE_SECONDS = 120
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+def _parse_ical_events(text: str) -> Dict[str, tuple]:
+    """Parsing bloccante del feed (eseguito in un thread): UID evento -> (check_in, check_out)"""
+    c = Calendar(text)
+    events = {}
+    for event in c.events:
+        start_date = event.begin.format("YYYY-MM-DD")
+        end_date = event.end.format("YYYY-MM-DD")
+        # Senza UID usiamo un'impronta stabile dell'evento
+        uid = event.uid or hashlib.sha1(f"{start_date}|{end_date}|{event.name}".encode()).hexdigest()
+        events[uid] = (start_date, end_date)
+    return events
+
+async def sync_room_calendar(room: dict) -> dict:
+    """Sincronizzazione incrementale del feed iCal di una stanza.
+
+    Usa ETag/Last-Modified e l'hash del contenuto per saltare i feed invariati;
+    altrimenti applica solo le differenze (upsert per UID, delete degli eventi
+    spariti) con un unico bulk_write.
+    """
+    room_id = room['id']
+    url = room['ical_import_url']
+    feed = await db.ical_feeds.find_one({"room_id": room_id}, {"_id": 0}) or {}
+    if feed.get("url") != url:
+        feed = {}
+
+    headers = {}
+    if feed.get("etag"):
+        headers["If-None-Match"] = feed["etag"]
+    if feed.get("last_modified"):
+        headers["If-Modified-Since"] = feed["last_modified"]
+
+    response = await asyncio.wait_for(http_client.get(url, headers=headers), timeout=ICAL_FETCH_TIMEOUT)
+    now = datetime.now(timezone.utc).isoformat()
+    feed_state = {
+        "room_id": room_id,
+        "url": url,
+        "etag": response.headers.get("ETag", feed.get("etag")),
+        "last_modified": response.headers.get("Last-Modified", feed.get("last_modified")),
+        "last_synced_at": now
+    }
+    result = {"events": feed.get("event_count", 0), "upserted": 0, "modified": 0, "deleted": 0, "unchanged": True}
+
+    if response.status_code == 304:
+        await db.ical_feeds.update_one({"room_id": room_id}, {"$set": feed_state}, upsert=True)
+        return result
+    if response.status_code != 200:
+        raise RuntimeError(f"Errore HTTP {response.status_code}")
+
+    content_hash = hashlib.sha256(response.content).hexdigest()
+    if content_hash == feed.get("content_hash"):
+        await db.ical_feeds.update_one({"room_id": room_id}, {"$set": feed_state}, upsert=True)
+        return result
+
+    events = await asyncio.to_thread(_parse_ical_events, response.text)
+
+    # Nota: 'external_ical' è la chiave fondamentale per distinguere prenotazioni reali da quelle importate
+    imported = {"room_id": room_id, "source": "external_ical"}
+    existing = await db.bookings.find(
+        imported, {"_id": 0, "room_id": 1, "status": 1, "external_uid": 1, "check_in": 1, "check_out": 1, "created_at": 1, "total_price": 1}
+    ).to_list(None)
+    existing_by_uid = {b["external_uid"]: b for b in existing if b.get("external_uid")}
+    changed = {
+        uid: stay for uid, stay in events.items()
+        if uid not in existing_by_uid or (existing_by_uid[uid]["check_in"], existing_by_uid[uid]["check_out"]) != stay
+    }
+    template = Booking(
+        room_id=room_id,
+        guest_email="noreply@booking.com",
+        guest_name="Imported Booking (iCal)",
+        check_in="",
+        check_out="",
+        num_guests=1,
+        total_price=0,
+        status="confirmed",
+        source="external_ical" # Fondamentale per riconoscerle
+    ).model_dump(exclude={"id", "room_id", "source", "external_uid", "check_in", "check_out", "updated_at"})
+    template["created_at"] = template["created_at"].isoformat()
+    ops = [
+        UpdateOne(
+            {**imported, "external_uid": uid},
+            {
+                "$set": {"check_in": start_date, "check_out": end_date, "updated_at": now},
+                "$setOnInsert": {**template, "id": str(uuid.uuid4())}
+            },
+            upsert=True
+        )
+        for uid, (start_date, end_date) in changed.items()
+    ]
+    # Rimuove gli eventi spariti dal feed (e le vecchie importazioni senza UID)
+    ops.append(DeleteMany({**imported, "external_uid": {"$nin": list(events)}}))
+
+    try:
+        bulk = await db.bookings.bulk_write(ops, ordered=False)
+    finally:
+        await occupancy_index.reload_room(room_id)
+        await occupancy_index.bump(room_id)
+
+    deltas = {}
+    for b in existing:
+        if b.get("external_uid") not in events or b["external_uid"] in changed:
+            _booking_stat_deltas(b, -1, deltas)
+    for uid, (start_date, end_date) in changed.items():
+        _booking_stat_deltas({"room_id": room_id, "status": "confirmed", "check_in": start_date,
+                              "check_out": end_date, "created_at": now, "total_price": 0}, 1, deltas)
+    try:
+        await apply_stat_deltas(deltas)
+    except Exception as e:
+        logger.error(f"Daily stats update failed: {e}")
+
+    feed_state.update({"content_hash": content_hash, "event_count": len(events)})
+    await db.ical_feeds.update_one({"room_id": room_id}, {"$set": feed_state}, upsert=True)
+    return {
+        "events": len(events),
+        "upserted": bulk.upserted_count,
+        "modified": bulk.modified_count,
+        "deleted": bulk.deleted_count,
+        "unchanged": False
+    }
+
+async def dedupe_ical_imports():
+    """Elimina le importazioni iCal doppie (stesso room_id/source/external_uid) lasciate
+    da sync concorrenti, così l'indice unique può essere creato"""
+    try:
+        await db.bookings.drop_index("room_source_uid")
+    except Exception:
+        pass
+    groups = await db.bookings.aggregate([
+        {"$match": {"external_uid": {"$type": "string"}}},
+        {"$group": {"_id": {"room_id": "$room_id", "source": "$source", "uid": "$external_uid"},
+                    "ids": {"$push": "$id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ]).to_list(None)
+    duplicates = [i for g in groups for i in g["ids"][1:]]
+    if not duplicates:
+        return
+    await db.bookings.delete_many({"id": {"$in": duplicates}})
+    await rebuild_daily_stats()
+    logger.info(f"Removed {len(duplicates)} duplicate iCal imports")
+
+async def _manual_room_sync(room: dict) -> dict:
+    """Sync richiesto a mano: prende lo stesso lease del sync programmato, ignorando next_sync_at"""
+    if not await _acquire_feed_lease(room["id"], datetime.now(timezone.utc), ignore_schedule=True):
+        raise RuntimeError("sincronizzazione già in corso")
+    update = {"lease_owner": None, "lease_until": None}
+    try:
+        result = await sync_room_calendar(room)
+        update.update({"failures": 0, "last_error": None,
+                       "next_sync_at": datetime.now(timezone.utc) + timedelta(seconds=_ical_backoff(0))})
+        return result
+    finally:
+        await db.ical_feeds.update_one({"room_id": room["id"], "lease_owner": WORKER_ID}, {"$set": update})
+
 @api_router.get("/ical/sync")
 async def sync_calendars():
-    """IMPORT: Pulisce le vecchie importazioni e riscarica i calendari aggiornati"""
-    rooms = await db.rooms.find({"ical_import_url": {"$ne": ""}}).to_list(100)
+    """IMPORT: Sincronizza in parallelo i calendari di tutte le stanze, applicando solo le differenze"""
+    rooms = await db.rooms.find({"ical_import_url": {"$nin": ["", None]}}).to_list(100)
+    results = await asyncio.gather(*(_manual_room_sync(room) for room in rooms), return_exceptions=True)
+
     count = 0
+    changes = {"upserted": 0, "modified": 0, "deleted": 0}
+    unchanged = []
     errors = []
-    
-    for room in rooms:
-        url = room['ical_import_url']
-        room_id = room['id']
-        
-        try:
-            # 1. Pulisci le vecchie importazioni per QUESTA stanza (evita duplicati e dati vecchi)
-            # Nota: 'external_ical' è la chiave fondamentale per distinguere prenotazioni reali da quelle importate
-            await db.bookings.delete_many({
-                "room_id": room_id,
-                "source": "external_ical"
-            })
-            
-            # 2. Scarica il calendario aggiornato
-            response = requests.get(url, timeout=10) # Timeout per sicurezza
-            if response.status_code != 200:
-                errors.append(f"Errore HTTP {response.status_code} per stanza {room['name_it']}")
-                continue
-
-            c = Calendar(response.text)
-            
-            for event in c.events:
-                start_date = event.begin.format("YYYY-MM-DD")
-                end_date = event.end.format("YYYY-MM-DD")
-                
-                # Crea la nuova prenotazione bloccata
-                new_booking = Booking(
-                    room_id=room_id,
-                    guest_email="noreply@booking.com",
-                    guest_name="Imported Booking (iCal)",
-                    check_in=start_date,
-                    check_out=end_date,
-                    num_guests=1,
-                    total_price=0,
-                    status="confirmed",
-                    source="external_ical" # Fondamentale per riconoscerle
-                )
-                await db.bookings.insert_one(new_booking.model_dump())
-                count += 1
-                
-        except Exception as e:
-            msg = f"Errore sync stanza {room['name_it']}: {str(e)}"
+    for room, result in zip(rooms, results):
+        if isinstance(result, Exception):
+            reason = "Timeout" if isinstance(result, asyncio.TimeoutError) else str(result)
+            msg = f"Errore sync stanza {room['name_it']}: {reason}"
             logger.error(msg)
             errors.append(msg)
+            continue
+        count += result["events"]
+        if result["unchanged"]:
+            unchanged.append(room['name_it'])
+        for k in changes:
+            changes[k] += result[k]
             
     return {
         "message": f"Sincronizzazione completata. {count} date bloccate.", 
+        "changes": changes,
+        "unchanged": unchanged,
         "errors": errors
     }
 
-@api_router.get("/ical/export/{room_id}")
-async def export_calendar(room_id: str):
-    """EXPORT: Genera il file .ics da dare a Booking"""
-    room = await db.rooms.find_one({"id": room_id})
-    if not room: raise HTTPException(404, "Room not found")
-    
-    c = Calendar()
+# --- SYNC PERIODICO (in-process) ---
+# Ogni feed ha il proprio next_sync_at in ical_feeds; un lease su Mongo garantisce
+# che, con più worker uvicorn, un solo processo sincronizzi un dato feed alla volta.
+
+def _ical_backoff(failures: int) -> float:
+    delay = ICAL_SYNC_INTERVAL * (2 ** failures) if failures else ICAL_SYNC_INTERVAL
+    delay = min(delay, ICAL_SYNC_MAX_BACKOFF)
+    return delay + random.uniform(0, delay * 0.1)
+
+async def _acquire_feed_lease(room_id: str, now: datetime, ignore_schedule: bool = False) -> Optional[dict]:
+    await db.ical_feeds.update_one({"room_id": room_id}, {"$setOnInsert": {"room_id": room_id}}, upsert=True)
+    conditions = [{"$or": [{"lease_until": {"$lte": now}}, {"lease_until": {"$exists": False}}, {"lease_until": None}]}]
+    if not ignore_schedule:
+        conditions.append({"$or": [{"next_sync_at": {"$lte": now}}, {"next_sync_at": {"$exists": False}}]})
+    return await db.ical_feeds.find_one_and_update(
+        {"room_id": room_id, "$and": conditions},
+        {"$set": {"lease_owner": WORKER_ID, "lease_until": now + timedelta(seconds=ICAL_LEASE_SECONDS)}},
+        projection={"_id": 0}, return_document=ReturnDocument.AFTER
+    )
+
+async def _scheduled_room_sync(room: dict, feed: dict):
+    failures = feed.get("failures", 0)
+    update = {"lease_owner": None, "lease_until": None}
+    try:
+        await sync_room_calendar(room)
+        failures = 0
+        update["last_error"] = None
+    except Exception as e:
+        failures += 1
+        reason = "Timeout" if isinstance(e, asyncio.TimeoutError) else str(e)
+        update["last_error"] = reason
+        logger.error(f"Sync programmato stanza {room['name_it']} fallito ({failures}): {reason}")
+    update["failures"] = failures
+    update["next_sync_at"] = datetime.now(timezone.utc) + timedelta(seconds=_ical_backoff(failures))
+    await db.ical_feeds.update_one({"room_id": room["id"], "lease_owner": WORKER_ID}, {"$set": update})
+
+async def run_due_ical_syncs():
+    rooms = await db.rooms.find({"ical_import_url": {"$nin": ["", None]}}, {"_id": 0}).to_list(100)
+    now = datetime.now(timezone.utc)
+    jobs = []
+    for room in rooms:
+        feed = await _acquire_feed_lease(room["id"], now)
+        if feed:
+            jobs.append(_scheduled_room_sync(room, feed))
+    if jobs:
+        await asyncio.gather(*jobs)
+
+async def ical_sync_scheduler():
+    # Sfasa l'avvio dei worker per evitare raffiche sincronizzate
+    await asyncio.sleep(random.uniform(0, ICAL_SYNC_TICK))
+    while True:
+        try:
+            await run_due_ical_syncs()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"iCal scheduler error: {e}")
+        await asyncio.sleep(ICAL_SYNC_TICK)
+
+# .ics già renderizzati per stanza: {"body", "version"}. La versione dell'export
+# (calendar_export_versions, condivisa tra i worker) cambia solo quando cambiano
+# prenotazioni confermate del sito o date bloccate della stanza: le pending e gli
+# import iCal non compaiono nell'export e non costringono le OTA a riscaricarlo.
+calendar_export_cache = LRUCache(maxsize=64, ttl=600)
+# Generazione locale per stanza: un export finito di trasmettere dopo
+# un'invalidazione non deve finire in cache con il contenuto vecchio
+calendar_export_generation: Dict[str, int] = {}
+
+async def invalidate_calendar_export(room_id: str):
+    await db.calendar_export_versions.update_one(
+        {"room_id": room_id},
+        {"$inc": {"version": 1}, "$set": {"updated_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+    calendar_export_cache.pop(room_id)
+    calendar_export_generation[room_id] = calendar_export_generation.get(room_id, 0) + 1
+
+def _affects_calendar_export(before: dict, after: dict) -> bool:
+    """Vero se la prenotazione entra o esce da 'confirmed' e non viene da un import iCal"""
+    if after.get("source") == "external_ical":
+        return False
+    return (before.get("status") == "confirmed") != (after.get("status") == "confirmed")
+
+async def _calendar_version(room_id: str) -> tuple:
+    """Versione dell'export della stanza (condivisa tra i worker) e data dell'ultima modifica"""
+    doc = await db.calendar_export_versions.find_one({"room_id": room_id}, {"_id": 0})
+    if not doc:
+        return 0, datetime(1970, 1, 1, tzinfo=timezone.utc)
+    updated_at = doc.get("updated_at")
+    last_modified = _as_utc(updated_at) if updated_at else datetime(1970, 1, 1, tzinfo=timezone.utc)
+    # Precisione al secondo, come l'header HTTP
+    return doc.get("version", 0), last_modified.replace(microsecond=0)
+
+ICS_CHUNK_EVENTS = 100
+
+def _ics_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+def _ics_timestamp(value) -> str:
+    """DTSTAMP stabile (dal documento, non dall'ora di render) così l'ETag non cambia a vuoto"""
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            value = None
+    if not isinstance(value, datetime):
+        value = datetime(1970, 1, 1, tzinfo=timezone.utc)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+def _ics_event(uid: str, summary: str, start: str, end: str, stamp) -> str:
+    return (
+        "BEGIN:VEVENT\r\n"
+        f"UID:{uid}\r\n"
+        f"DTSTAMP:{_ics_timestamp(stamp)}\r\n"
+        f"DTSTART;VALUE=DATE:{start.replace('-', '')}\r\n"
+        f"DTEND;VALUE=DATE:{end.replace('-', '')}\r\n"
+        f"SUMMARY:{_ics_escape(summary)}\r\n"
+        "END:VEVENT\r\n"
+    )
+
+async def iter_calendar(room_id: str, window_from: Optional[str] = None, window_to: Optional[str] = None):
+    """Scrive il VCALENDAR a blocchi direttamente dai cursori Mongo, senza il modello a oggetti di ics.
+
+    La finestra opzionale [window_from, window_to) filtra gli eventi che vi si sovrappongono.
+    """
+    yield (
+        "BEGIN:VCALENDAR\r\n"
+        "VERSION:2.0\r\n"
+        "PRODID:-//Desideri di Puglia//Calendar Export//IT\r\n"
+        "CALSCALE:GREGORIAN\r\n"
+    )
+
     # Esportiamo solo le prenotazioni confermate che NON vengono da iCal (per evitare loop)
-    # Se vuoi esportare TUTTO quello che è occupato (anche blocchi manuali), togli 'source': 'website'
-    # Solitamente si esportano solo le prenotazioni dirette del sito.
-    bookings = await db.bookings.find({
-        "room_id": room_id, 
-        "status": "confirmed",
-        "source": {"$ne": "external_ical"} 
-    }).to_list(1000)
-    
-    blocked = await db.blocked_dates.find({"room_id": room_id}).to_list(1000)
-
-    for b in bookings:
-        e = Event()
-        e.name = f"Prenotazione: {b.get('guest_name', 'Ospite')}"
-        e.begin = b['check_in']
-        e.end = b['check_out']
-        e.uid = b['id']
-        c.events.add(e)
-        
-    for blk in blocked:
-        e = Event()
-        e.name = "Chiuso Manualmente"
-        e.begin = blk['date']
-        # I blocchi manuali sono di 1 giorno, quindi end è il giorno dopo o stesso giorno (dipende dalla logica)
-        # Qui assumiamo blocco giornaliero
-        next_day = (datetime.strptime(blk['date'], "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
-        e.end = next_day
-        e.uid = blk['id']
-        c.events.add(e)
-        
-    from fastapi.responses import Response
-    return Response(content=str(c), media_type="text/calendar")
+    bookings_q = {"room_id": room_id, "status": "confirmed", "source": {"$ne": "external_ical"}}
+    if window_from:
+        bookings_q["check_out"] = {"$gt": window_from}
+    if window_to:
+        bookings_q["check_in"] = {"$lt": window_to}
+    blocked_q = {"room_id": room_id}
+    if window_from:
+        blocked_q["end"] = {"$gt": window_from}
+    if window_to:
+        blocked_q["start"] = {"$lt": window_to}
+
+    chunk = []
+    bookings = db.bookings.find(bookings_q, {"_id": 0, "id": 1, "guest_name": 1, "check_in": 1, "check_out": 1, "updated_at": 1, "created_at": 1})
+    async for b in bookings:
+        chunk.append(_ics_event(
+            b['id'], f"Prenotazione: {b.get('guest_name', 'Ospite')}",
+            b['check_in'], b['check_out'], b.get('updated_at') or b.get('created_at')
+        ))
+        if len(chunk) >= ICS_CHUNK_EVENTS:
+            yield "".join(chunk)
+            chunk = []
+
+    async for blk in db.blocked_dates.find(blocked_q, {"_id": 0}):
+        chunk.append(_ics_event(blk['id'], "Chiuso Manualmente", blk['start'], blk['end'], blk.get('created_at')))
+        if len(chunk) >= ICS_CHUNK_EVENTS:
+            yield "".join(chunk)
+            chunk = []
+
+    chunk.append("END:VCALENDAR\r\n")
+    yield "".join(chunk)
+
+async def _stream_and_cache_calendar(room_id: str, version: int):
+    """Stream dell'export completo che, a fine risposta, popola la cache per i poll successivi
+    (solo se nel frattempo la stanza non è stata invalidata)"""
+    generation = calendar_export_generation.get(room_id, 0)
+    parts = []
+    async for part in iter_calendar(room_id):
+        parts.append(part)
+        yield part
+    if calendar_export_generation.get(room_id, 0) == generation:
+        calendar_export_cache.set(room_id, {"body": "".join(parts), "version": version})
+
+@api_router.get("/ical/export/{room_id}")
+async def export_calendar(room_id: str, request: Request,
+                          window_from: Optional[str] = Query(None, alias="from"),
+                          window_to: Optional[str] = Query(None, alias="to")):
+    """EXPORT: Genera il file .ics da dare a Booking (in streaming; cache, ETag e 304 per i poller delle OTA)"""
+    try:
+        # Forma canonica YYYY-MM-DD: fromisoformat accetta anche 20250101, che nei
+        # confronti tra stringhe darebbe finestre sbagliate
+        window_from = date.fromisoformat(window_from).isoformat() if window_from else None
+        window_to = date.fromisoformat(window_to).isoformat() if window_to else None
+    except ValueError:
+        raise HTTPException(400, "Formato data non valido (YYYY-MM-DD)")
+
+    if not await room_catalog.get(room_id): raise HTTPException(404, "Room not found")
+
+    # Validatori dalla versione dell'export: disponibili anche prima di generare il file
+    version, last_modified = await _calendar_version(room_id)
+    windowed = bool(window_from or window_to)
+    etag = f'"cal-{room_id}-{version}"'
+    if windowed:
+        etag = f'"cal-{room_id}-{version}-{window_from or ""}-{window_to or ""}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": format_datetime(last_modified, usegmt=True),
+        "Cache-Control": "no-cache"
+    }
+    if _not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+
+    if windowed:
+        return StreamingResponse(iter_calendar(room_id, window_from, window_to), media_type="text/calendar", headers=headers)
+    cached = calendar_export_cache.get(room_id)
+    if cached is None or cached["version"] != version:
+        return StreamingResponse(_stream_and_cache_calendar(room_id, version), media_type="text/calendar", headers=headers)
+    return Response(content=cached["body"], media_type="text/calendar", headers=headers)
 
 # ==================== ENDPOINTS BASE ====================
 
@@ -420,15 +1695,15 @@ async def health_check():
     return {"status": "ok", "message": "Server is running"}
 
 @api_router.get("/rooms")
-async def get_rooms():
-    return await db.rooms.find({}, {"_id": 0}).to_list(100)
+async def get_rooms(request: Request):
+    return await room_catalog.list_response(request)
 
 @api_router.get("/rooms/{room_id}")
-async def get_room(room_id: str):
-    room = await db.rooms.find_one({"id": room_id}, {"_id": 0})
-    if not room:
+async def get_room(room_id: str, request: Request):
+    response = await room_catalog.room_response(request, room_id)
+    if response is None:
         raise HTTPException(status_code=404, detail="Room not found")
-    return room
+    return response
 
 @api_router.put("/rooms/{room_id}")
 async def update_room(room_id: str, update: RoomUpdate):
@@ -436,41 +1711,28 @@ async def update_room(room_id: str, update: RoomUpdate):
     if update_data:
         update_data["updated_at"] = datetime.now(timezone.utc).isoformat()
         await db.rooms.update_one({"id": room_id}, {"$set": update_data})
+        if "price_per_night" in update_data:
+            invalidate_quotes()
+        await room_catalog.load()
     room = await db.rooms.find_one({"id": room_id}, {"_id": 0})
     return room
 
 @api_router.get("/availability/{room_id}")
 async def get_availability(room_id: str, start_date: str, end_date: str):
-    # Logica robusta: prende TUTTO ciò che occupa la stanza
-    bookings = await db.bookings.find({
-        "room_id": room_id,
-        "status": {"$in": ["pending", "confirmed"]},
-        "$or": [{"check_in": {"$lte": end_date}, "check_out": {"$gte": start_date}}]
-    }, {"_id": 0}).to_list(1000)
-    
-    blocked = await db.blocked_dates.find({
-        "room_id": room_id,
-        "date": {"$gte": start_date, "$lte": end_date}
-    }, {"_id": 0}).to_list(1000)
+    # Le notti occupate (prenotazioni + blocchi) arrivano dall'indice in memoria
+    await occupancy_index.ensure_fresh(room_id)
+    try:
+        unavailable_dates = occupancy_index.unavailable_dates(room_id, start_date, end_date)
+    except ValueError:
+        raise HTTPException(400, "Formato data non valido (YYYY-MM-DD)")
     
     custom_prices = await db.custom_prices.find({
         "room_id": room_id,
         "date": {"$gte": start_date, "$lte": end_date}
     }, {"_id": 0}).to_list(1000)
-    
-    unavailable_dates = set()
-    for booking in bookings:
-        current = datetime.strptime(booking["check_in"], "%Y-%m-%d")
-        end = datetime.strptime(booking["check_out"], "%Y-%m-%d")
-        while current < end:
-            unavailable_dates.add(current.strftime("%Y-%m-%d"))
-            current += timedelta(days=1)
-            
-    for block in blocked:
-        unavailable_dates.add(block["date"])
         
     prices_by_date = {cp["date"]: cp["price"] for cp in custom_prices}
-    return {"unavailable_dates": list(unavailable_dates), "custom_prices": prices_by_date}
+    return {"unavailable_dates": unavailable_dates, "custom_prices": prices_by_date}
 
 # --- CUSTOM PRICES ---
 @api_router.get("/custom-prices/{room_id}")
@@ -482,30 +1744,69 @@ async def get_custom_prices(room_id: str, start_date: Optional[str] = None, end_
 
 @api_router.post("/custom-prices")
 async def set_custom_prices(data: CustomPriceCreate):
-    current = datetime.strptime(data.start_date, "%Y-%m-%d")
-    end = datetime.strptime(data.end_date, "%Y-%m-%d")
-    count = 0
-    while current <= end:
-        date_str = current.strftime("%Y-%m-%d")
-        await db.custom_prices.update_one(
-            {"room_id": data.room_id, "date": date_str},
-            {"$set": {"room_id": data.room_id, "date": date_str, "price": data.price, "reason": data.reason}},
+    room_ids = data.room_ids or ([data.room_id] if data.room_id else [])
+    ranges = data.ranges or ([DateRange(start_date=data.start_date, end_date=data.end_date)]
+                             if data.start_date and data.end_date else [])
+    if not room_ids or not ranges:
+        raise HTTPException(400, "room_id/room_ids e start_date/end_date (o ranges) sono obbligatori")
+
+    dates = set()
+    try:
+        for r in ranges:
+            current = date.fromisoformat(r.start_date)
+            end = date.fromisoformat(r.end_date)
+            while current <= end:
+                if data.weekdays is None or current.weekday() in data.weekdays:
+                    dates.add(current.isoformat())
+                current += timedelta(days=1)
+    except ValueError:
+        raise HTTPException(400, "Formato data non valido (YYYY-MM-DD)")
+
+    ops = [
+        UpdateOne(
+            {"room_id": room_id, "date": date_str},
+            {"$set": {"room_id": room_id, "date": date_str, "price": data.price, "reason": data.reason}},
             upsert=True
         )
-        count += 1
-        current += timedelta(days=1)
-    return {"message": f"Custom prices set for {count} days"}
+        for room_id in room_ids for date_str in sorted(dates)
+    ]
+    if not ops:
+        return {"message": "Custom prices set for 0 days", "matched": 0, "modified": 0, "upserted": 0}
+
+    result = await db.custom_prices.bulk_write(ops, ordered=False)
+    invalidate_quotes()
+    return {
+        "message": f"Custom prices set for {len(dates)} days",
+        "matched": result.matched_count,
+        "modified": result.modified_count,
+        "upserted": result.upserted_count
+    }
 
 @api_router.delete("/custom-prices/{room_id}/{date}")
 async def delete_custom_price(room_id: str, date: str):
     await db.custom_prices.delete_one({"room_id": room_id, "date": date})
+    invalidate_quotes()
     return {"message": "Custom price deleted"}
 
 # --- UPSELLS ---
 @api_router.get("/upsells")
-async def get_upsells(active_only: bool = False):
-    query = {"is_active": True} if active_only else {}
-    return await db.upsells.find(query, {"_id": 0}).sort("order", 1).to_list(100)
+async def get_upsells(request: Request, active_only: bool = False, nights: Optional[int] = Query(None, ge=0)):
+    """Dal catalogo in memoria; con `nights` solo gli upsell attivi idonei per quella durata"""
+    await upsell_catalog.ensure_fresh()
+    headers = {"ETag": upsell_catalog.version, "Cache-Control": "no-cache"}
+    if _not_modified(request, upsell_catalog.version, upsell_catalog.last_modified):
+        return Response(status_code=304, headers=headers)
+    if nights is not None:
+        upsells = upsell_catalog.eligible(nights)
+    elif active_only:
+        upsells = [u for u in upsell_catalog.upsells if u.get("is_active", True)]
+    else:
+        upsells = upsell_catalog.upsells
+    return Response(content=json.dumps(upsells), media_type="application/json", headers=headers)
+
+async def refresh_upsells():
+    await upsell_catalog.load()
+    invalidate_quotes()
 
 @api_router.post("/upsells")
 async def create_upsell(data: UpsellCreate):
@@ -516,6 +1817,7 @@ async def create_upsell(data: UpsellCreate):
     upsell_dict = upsell.model_dump()
     upsell_dict["created_at"] = upsell_dict["created_at"].isoformat()
     await db.upsells.insert_one(upsell_dict)
+    await refresh_upsells()
     return {"message": "Upsell created", "id": upsell.id}
 
 @api_router.put("/upsells/{upsell_id}")
@@ -523,49 +1825,166 @@ async def update_upsell(upsell_id: str, data: UpsellUpdate):
     update_data = {k: v for k, v in data.model_dump().items() if v is not None}
     if update_data:
         await db.upsells.update_one({"id": upsell_id}, {"$set": update_data})
-    return await db.upsells.find_one({"id": upsell_id}, {"_id": 0})
+        await refresh_upsells()
+    await upsell_catalog.ensure_fresh()
+    return upsell_catalog.by_id.get(upsell_id)
 
 @api_router.delete("/upsells/{upsell_id}")
 async def delete_upsell(upsell_id: str):
     await db.upsells.delete_one({"id": upsell_id})
+    await refresh_upsells()
     return {"message": "Upsell deleted"}
 
 # --- BLOCKED DATES ---
-@api_router.get("/blocked-dates/{room_id}")
-async def get_blocked_dates(room_id: str):
-    return await db.blocked_dates.find({"room_id": room_id}, {"_id": 0}).to_list(1000)
+# I blocchi sono intervalli {room_id, start, end, reason} con end escluso (come check_out).
+# Gli intervalli di una stanza non si sovrappongono mai: blocco e sblocco li fondono o li dividono.
 
-@api_router.post("/blocked-dates/range")
-async def block_date_range(room_id: str, start_date: str, end_date: Optional[str] = None, reason: Optional[str] = None):
-    if not end_date:
-        end_date = start_date
+def _new_block(room_id: str, start: str, end: str, reason: Optional[str], created_at: Optional[str] = None) -> dict:
+    return {
+        "id": str(uuid.uuid4()),
+        "room_id": room_id,
+        "start": start,
+        "end": end,
+        "reason": reason,
+        "created_at": created_at or datetime.now(timezone.utc).isoformat()
+    }
 
+def _parse_block_range(start_date: str, end_date: Optional[str]) -> tuple:
+    """Intervallo API (estremi inclusi) -> (start, end) con end escluso"""
     try:
-        current = datetime.strptime(start_date, "%Y-%m-%d")
-        end = datetime.strptime(end_date, "%Y-%m-%d")
+        start = date.fromisoformat(start_date)
+        end = date.fromisoformat(end_date or start_date)
     except ValueError:
         raise HTTPException(400, "Formato data non valido (YYYY-MM-DD)")
-        
-    blocked_count = 0
-    while current <= end:
-        date_str = current.strftime("%Y-%m-%d")
-        existing = await db.blocked_dates.find_one({"room_id": room_id, "date": date_str})
-        if not existing:
-            await db.blocked_dates.insert_one({
-                "id": str(uuid.uuid4()),
-                "room_id": room_id,
-                "date": date_str,
-                "reason": reason,
-                "created_at": datetime.now(timezone.utc).isoformat()
-            })
-            blocked_count += 1
-        current += timedelta(days=1)
-        
+    if end < start:
+        raise HTTPException(400, "end_date must not be before start_date")
+    return start.isoformat(), (end + timedelta(days=1)).isoformat()
+
+def _days_between(start: str, end: str) -> int:
+    return (date.fromisoformat(end) - date.fromisoformat(start)).days
+
+async def _apply_block_changes(room_id: str, removed: List[dict], added: List[dict]):
+    """Applica rimozioni e inserimenti di intervalli con un solo bulk_write e aggiorna indice e cache"""
+    ops = []
+    if removed:
+        ops.append(DeleteMany({"id": {"$in": [blk["id"] for blk in removed]}}))
+    ops.extend(InsertOne(dict(blk)) for blk in added)
+    if not ops:
+        return
+    await db.blocked_dates.bulk_write(ops, ordered=True)
+    for blk in removed:
+        occupancy_index.remove_blocked(blk["id"])
+    for blk in added:
+        occupancy_index.apply_blocked(blk)
+    await occupancy_index.bump(room_id)
+    await invalidate_calendar_export(room_id)
+
+async def block_range(room_id: str, start: str, end: str, reason: Optional[str]) -> int:
+    """Blocca [start, end) e restituisce i giorni nuovi. Gli intervalli con lo stesso motivo
+    sovrapposti o adiacenti vengono fusi; quelli con un motivo diverso vengono tagliati
+    ai bordi del nuovo intervallo, conservando il loro motivo fuori da [start, end)."""
+    touching = await db.blocked_dates.find(
+        {"room_id": room_id, "start": {"$lte": end}, "end": {"$gte": start}}, {"_id": 0}
+    ).to_list(None)
+    already = sum(max(0, _days_between(max(start, blk["start"]), min(end, blk["end"]))) for blk in touching)
+    new_days = max(0, _days_between(start, end) - already)
+
+    same = [blk for blk in touching if blk.get("reason") == reason]
+    other = [blk for blk in touching if blk.get("reason") != reason and blk["start"] < end and blk["end"] > start]
+    if not new_days and not other and len(same) <= 1:
+        return 0
+
+    remainders = []
+    for blk in other:
+        if blk["start"] < start:
+            remainders.append(_new_block(room_id, blk["start"], start, blk.get("reason"), blk.get("created_at")))
+        if blk["end"] > end:
+            remainders.append(_new_block(room_id, end, blk["end"], blk.get("reason"), blk.get("created_at")))
+    merged = _new_block(
+        room_id,
+        min([start] + [blk["start"] for blk in same]),
+        max([end] + [blk["end"] for blk in same]),
+        reason,
+        min([blk["created_at"] for blk in same], default=None)
+    )
+    await _apply_block_changes(room_id, same + other, remainders + [merged])
+    return new_days
+
+async def unblock_range(room_id: str, start: str, end: str) -> int:
+    """Sblocca [start, end) dividendo gli intervalli che lo attraversano; restituisce i giorni liberati"""
+    overlapping = await db.blocked_dates.find(
+        {"room_id": room_id, "start": {"$lt": end}, "end": {"$gt": start}}, {"_id": 0}
+    ).to_list(None)
+    freed = 0
+    remainders = []
+    for blk in overlapping:
+        freed += _days_between(max(start, blk["start"]), min(end, blk["end"]))
+        if blk["start"] < start:
+            remainders.append(_new_block(room_id, blk["start"], start, blk.get("reason"), blk.get("created_at")))
+        if blk["end"] > end:
+            remainders.append(_new_block(room_id, end, blk["end"], blk.get("reason"), blk.get("created_at")))
+    await _apply_block_changes(room_id, overlapping, remainders)
+    return freed
+
+async def migrate_blocked_dates():
+    """Converte i vecchi documenti giornalieri {date} in intervalli, fondendo i giorni consecutivi"""
+    try:
+        await db.blocked_dates.drop_index("room_date_unique")
+    except Exception:
+        pass
+    legacy = await db.blocked_dates.find({"date": {"$exists": True}}, {"_id": 0}).sort([("room_id", 1), ("date", 1)]).to_list(None)
+    if not legacy:
+        return
+
+    intervals = []
+    for doc in legacy:
+        start = doc["date"]
+        end = (date.fromisoformat(start) + timedelta(days=1)).isoformat()
+        last = intervals[-1] if intervals else None
+        if last and last["room_id"] == doc["room_id"] and last["reason"] == doc.get("reason") and last["end"] >= start:
+            last["end"] = max(last["end"], end)
+        else:
+            intervals.append(_new_block(doc["room_id"], start, end, doc.get("reason"), doc.get("created_at")))
+
+    # Un solo bulk_write: gli intervalli vengono scritti prima di eliminare i giorni vecchi
+    ops = [InsertOne(blk) for blk in intervals]
+    ops.append(DeleteMany({"id": {"$in": [doc["id"] for doc in legacy]}, "date": {"$exists": True}}))
+    await db.blocked_dates.bulk_write(ops, ordered=True)
+    for room_id in {blk["room_id"] for blk in intervals}:
+        await invalidate_calendar_export(room_id)
+    logger.info(f"Migrated {len(legacy)} blocked days into {len(intervals)} intervals")
+
+@api_router.get("/blocked-dates/{room_id}")
+async def get_blocked_dates(room_id: str, intervals: bool = False):
+    blocks = await db.blocked_dates.find({"room_id": room_id}, {"_id": 0}).sort("start", 1).to_list(None)
+    if intervals:
+        return blocks
+    # Vista giornaliera per il pannello admin, espansa dagli intervalli
+    days = []
+    for blk in blocks:
+        current = date.fromisoformat(blk["start"])
+        end = date.fromisoformat(blk["end"])
+        while current < end:
+            days.append({"id": blk["id"], "room_id": room_id, "date": current.isoformat(), "reason": blk.get("reason")})
+            current += timedelta(days=1)
+    return days
+
+@api_router.post("/blocked-dates/range")
+async def block_date_range(room_id: str, start_date: str, end_date: Optional[str] = None, reason: Optional[str] = None):
+    start, end = _parse_block_range(start_date, end_date)
+    blocked_count = await block_range(room_id, start, end, reason)
     return {"message": f"{blocked_count} date bloccate."}
 
+@api_router.delete("/blocked-dates/range")
+async def unblock_date_range(room_id: str, start_date: str, end_date: Optional[str] = None):
+    start, end = _parse_block_range(start_date, end_date)
+    unblocked_count = await unblock_range(room_id, start, end)
+    return {"message": f"{unblocked_count} date sbloccate."}
+
 @api_router.delete("/blocked-dates/{room_id}/{date}")
 async def remove_blocked_date(room_id: str, date: str):
-    await db.blocked_dates.delete_one({"room_id": room_id, "date": date})
+    start, end = _parse_block_range(date, None)
+    await unblock_range(room_id, start, end)
     return {"message": "Date unblocked"}
 
 # --- COUPONS ---
@@ -583,6 +2002,7 @@ async def create_coupon(coupon_data: CouponCreate):
     c_dict = coupon.model_dump()
     c_dict["created_at"] = c_dict["created_at"].isoformat()
     await db.coupons.insert_one(c_dict)
+    invalidate_quotes()
     return {"message": "Coupon created", "coupon_id": coupon.id}
 
 @api_router.get("/coupons/validate/{code}")
@@ -599,58 +2019,53 @@ async def validate_coupon(code: str, nights: int = 1):
 @api_router.put("/coupons/{coupon_id}")
 async def update_coupon(coupon_id: str, is_active: bool):
     await db.coupons.update_one({"id": coupon_id}, {"$set": {"is_active": is_active}})
+    invalidate_quotes()
     return {"message": "Updated"}
 
 @api_router.delete("/coupons/{coupon_id}")
 async def delete_coupon(coupon_id: str):
     await db.coupons.delete_one({"id": coupon_id})
+    invalidate_quotes()
     return {"message": "Deleted"}
 
+# --- QUOTE ---
+@api_router.get("/quote")
+async def get_quote(room_id: str, check_in: str, check_out: str,
+                    upsell_ids: Optional[List[str]] = Query(None), coupon_code: Optional[str] = None):
+    """Preventivo senza effetti collaterali: stessa logica di create_booking, nessuna scrittura"""
+    key = (room_id, check_in, check_out, tuple(upsell_ids or ()), (coupon_code or "").upper())
+    cached = quote_cache.get(key)
+    if cached is not None:
+        return cached
+
+    room = await room_catalog.get(room_id)
+    if not room:
+        raise HTTPException(status_code=404, detail="Room not found")
+    quote = await quote_stay(room, check_in, check_out, upsell_ids, coupon_code)
+    quote.update({"room_id": room_id, "check_in": check_in, "check_out": check_out})
+    quote_cache.set(key, quote)
+    return quote
+
 # --- BOOKINGS & STRIPE ---
 
 @api_router.post("/bookings")
 async def create_booking(booking_data: BookingCreate):
-    room = await db.rooms.find_one({"id": booking_data.room_id}, {"_id": 0})
+    room = await room_catalog.get(booking_data.room_id)
     if not room:
         raise HTTPException(status_code=404, detail="Room not found")
     
-    check_in = datetime.strptime(booking_data.check_in, "%Y-%m-%d")
-    check_out = datetime.strptime(booking_data.check_out, "%Y-%m-%d")
-    nights = (check_out - check_in).days
-    
-    room_price = 0.0
-    current = check_in
-    default_price = float(room["price_per_night"])
-    while current < check_out:
-        date_str = current.strftime("%Y-%m-%d")
-        custom = await db.custom_prices.find_one({"room_id": booking_data.room_id, "date": date_str})
-        room_price += float(custom["price"]) if custom else default_price
-        current += timedelta(days=1)
-        
-    upsells_total = 0.0
-    upsell_ids = []
-    if booking_data.upsell_ids:
-        for uid in booking_data.upsell_ids:
-            upsell = await db.upsells.find_one({"id": uid, "is_active": True})
-            if upsell:
-                upsells_total += float(upsell["price"])
-                upsell_ids.append(uid)
-                
-    subtotal = room_price + upsells_total
-    
-    discount_amount = 0.0
-    coupon_code = None
-    if booking_data.coupon_code:
-        coupon = await db.coupons.find_one({"code": booking_data.coupon_code.upper()})
-        if coupon and coupon["is_active"]:
-            coupon_code = coupon["code"]
-            if coupon["discount_type"] == "percentage":
-                discount_amount = room_price * (coupon["discount_value"]/100)
-            else:
-                discount_amount = min(coupon["discount_value"], room_price)
-            await db.coupons.update_one({"code": coupon_code}, {"$inc": {"uses_count": 1}})
-            
-    total_price = subtotal - discount_amount
+    quote = await quote_stay(room, booking_data.check_in, booking_data.check_out,
+                             booking_data.upsell_ids, booking_data.coupon_code)
+    nights = quote["nights"]
+    room_price = quote["room_price"]
+    upsells_total = quote["upsells_total"]
+    upsell_ids = quote["upsells"]
+    coupon_code = quote["coupon_code"]
+    discount_amount = quote["discount_amount"]
+    total_price = quote["total_price"]
+
+    if coupon_code:
+        await db.coupons.update_one({"code": coupon_code}, {"$inc": {"uses_count": 1}})
 
     booking = Booking(
         room_id=booking_data.room_id,
@@ -667,29 +2082,30 @@ async def create_booking(booking_data: BookingCreate):
         notes=booking_data.notes,
         coupon_code=coupon_code,
         discount_amount=discount_amount,
-        stay_reason=booking_data.stay_reason
+        stay_reason=booking_data.stay_reason,
+        language=booking_data.language
     )
 
     host_url = booking_data.origin_url.rstrip('/')
     try:
-        session = stripe.checkout.Session.create(
-            payment_method_types=['card'],
-            line_items=[{
+        session = await payment_gateway.create_checkout_session({
+            'payment_method_types': ['card'],
+            'line_items': [{
                 'price_data': {
                     'currency': 'eur',
                     'product_data': {
                         'name': f"Prenotazione: {room['name_it']}",
                         'description': f"{nights} notti - {booking_data.check_in} / {booking_data.check_out}"
                     },
-                    'unit_amount': int(total_price * 100),
+                    'unit_amount': int(round(total_price * 100)),
                 },
                 'quantity': 1,
             }],
-            mode='payment',
-            success_url=f"{host_url}/booking/success?session_id={{CHECKOUT_SESSION_ID}}",
-            cancel_url=f"{host_url}/booking/cancel",
-            metadata={"booking_id": booking.id}
-        )
+            'mode': 'payment',
+            'success_url': f"{host_url}/booking/success?session_id={{CHECKOUT_SESSION_ID}}",
+            'cancel_url': f"{host_url}/booking/cancel",
+            'metadata': {"booking_id": booking.id}
+        }, idempotency_key=f"checkout-{booking.id}")
     except Exception as e:
         logger.error(f"STRIPE ERROR: {e}")
         raise HTTPException(status_code=500, detail="Payment session error")
@@ -699,6 +2115,9 @@ async def create_booking(booking_data: BookingCreate):
     b_dict["created_at"] = b_dict["created_at"].isoformat()
     b_dict["updated_at"] = b_dict["updated_at"].isoformat()
     await db.bookings.insert_one(b_dict)
+    occupancy_index.apply_booking(b_dict)
+    await occupancy_index.bump(b_dict["room_id"])
+    await record_booking_transition(None, b_dict)
     
     pt = PaymentTransaction(booking_id=booking.id, session_id=session.id, amount=total_price)
     pt_dict = pt.model_dump()
@@ -713,35 +2132,278 @@ async def create_booking(booking_data: BookingCreate):
         "total_price": total_price
     }
 
+# Sessioni già concluse (pagate o scadute): la pagina di successo continua a
+# interrogare lo stato, ma l'esito non cambia più e si risponde dalla memoria
+resolved_sessions_cache = LRUCache(maxsize=1024, ttl=120)
+
+async def apply_checkout_result(session_id: str, payment_status: str, session_status: str) -> Optional[dict]:
+    """Applica alla prenotazione l'esito di una sessione Checkout (da webhook o da
+    polling). La transizione è un solo find_one_and_update con precondizione sullo
+    stato di pagamento: tra richieste concorrenti vince una sola, e solo quella
+    aggiorna statistiche e accoda l'email di conferma."""
+    if payment_status == "paid":
+        changes = {"status": "confirmed", "payment_status": "paid"}
+        precondition = {"$ne": "paid"}
+    elif session_status == "expired":
+        # Una sessione già pagata non viene mai annullata da un evento tardivo
+        changes = {"status": "cancelled", "payment_status": "expired"}
+        precondition = {"$nin": ["paid", "expired"]}
+    else:
+        return await db.bookings.find_one({"stripe_session_id": session_id}, {"_id": 0})
+
+    before = await db.bookings.find_one_and_update(
+        {"stripe_session_id": session_id, "payment_status": precondition},
+        {"$set": changes},
+        projection={"_id": 0}, return_document=ReturnDocument.BEFORE
+    )
+    if not before:
+        # Transizione già avvenuta (o prenotazione inesistente)
+        return await db.bookings.find_one({"stripe_session_id": session_id}, {"_id": 0})
+
+    booking = {**before, **changes}
+    await db.payment_transactions.update_one({"session_id": session_id}, {"$set": {"payment_status": changes["payment_status"]}})
+    occupancy_index.apply_booking(booking)
+    await occupancy_index.bump(booking["room_id"])
+    if _affects_calendar_export(before, booking):
+        await invalidate_calendar_export(booking["room_id"])
+    if before.get("status") != booking["status"]:
+        await record_booking_transition(before, booking)
+    if payment_status == "paid":
+        room = await room_catalog.get(booking["room_id"]) or {}
+        await send_booking_confirmation_task(booking, room)
+    return booking
+
+def _local_session_status(booking: dict) -> str:
+    # Stesso vocabolario di Checkout Session.status, che il frontend già interpreta
+    return {"paid": "complete", "expired": "expired"}.get(booking.get("payment_status"), "open")
+
 @api_router.get("/bookings/status/{session_id}")
-async def check_booking_status(session_id: str, background_tasks: BackgroundTasks):
-    session = stripe.checkout.Session.retrieve(session_id)
-    booking = await db.bookings.find_one({"stripe_session_id": session_id}, {"_id": 0})
-    if not booking: raise HTTPException(404, "Not found")
-    
-    prev_status = booking.get("payment_status")
-    
-    if session.payment_status == "paid":
-        await db.bookings.update_one({"stripe_session_id": session_id}, {"$set": {"status": "confirmed", "payment_status": "paid"}})
-        if prev_status != "paid":
-            room = await db.rooms.find_one({"id": booking["room_id"]}, {"_id": 0})
-            background_tasks.add_task(send_booking_confirmation_task, booking, room['name_it'])
-            
-    elif session.status == "expired":
-        await db.bookings.update_one({"stripe_session_id": session_id}, {"$set": {"status": "cancelled", "payment_status": "expired"}})
-        
-    updated = await db.bookings.find_one({"stripe_session_id": session_id}, {"_id": 0})
-    return {"payment_status": session.payment_status, "status": session.status, "booking": updated}
+async def check_booking_status(session_id: str):
+    """Con i webhook attivi lo stato arriva da /stripe/webhook e qui si legge solo il DB;
+    senza STRIPE_WEBHOOK_SECRET si ripiega sull'interrogazione diretta di Stripe"""
+    cached = resolved_sessions_cache.get(session_id)
+    if cached is not None:
+        return cached
+
+    if STRIPE_WEBHOOK_SECRET:
+        booking = await db.bookings.find_one({"stripe_session_id": session_id}, {"_id": 0})
+        if not booking: raise HTTPException(404, "Not found")
+        result = {"payment_status": booking.get("payment_status"), "status": _local_session_status(booking), "booking": booking}
+    else:
+        try:
+            session = await payment_gateway.retrieve_checkout_session(session_id)
+        except stripe.StripeError as e:
+            logger.error(f"STRIPE ERROR: {e}")
+            raise HTTPException(status_code=502, detail="Payment provider error")
+        booking = await apply_checkout_result(session_id, session.payment_status, session.status)
+        if not booking: raise HTTPException(404, "Not found")
+        result = {"payment_status": session.payment_status, "status": session.status, "booking": booking}
+
+    if result["payment_status"] == "paid" or result["status"] == "expired":
+        resolved_sessions_cache.set(session_id, result)
+    return result
+
+# --- STRIPE WEBHOOK ---
+
+STRIPE_CHECKOUT_EVENTS = {"checkout.session.completed", "checkout.session.expired"}
+
+@api_router.post("/stripe/webhook")
+async def stripe_webhook(request: Request):
+    """Eventi Checkout firmati da Stripe. Ogni evento viene registrato in stripe_events
+    (id univoco) prima di essere applicato, così le riconsegne vengono ignorate."""
+    if not STRIPE_WEBHOOK_SECRET:
+        raise HTTPException(503, "Webhook not configured")
+    payload = await request.body()
+    try:
+        event = stripe.Webhook.construct_event(payload, request.headers.get("stripe-signature", ""), STRIPE_WEBHOOK_SECRET)
+    except (ValueError, stripe.SignatureVerificationError):
+        raise HTTPException(400, "Invalid signature")
+
+    if event["type"] not in STRIPE_CHECKOUT_EVENTS:
+        return {"received": True}
+
+    try:
+        await db.stripe_events.insert_one({
+            "id": event["id"],
+            "type": event["type"],
+            "received_at": datetime.now(timezone.utc)
+        })
+    except DuplicateKeyError:
+        return {"received": True, "duplicate": True}
+
+    session = event["data"]["object"]
+    try:
+        await apply_checkout_result(session["id"], session.get("payment_status"), session.get("status"))
+    except Exception:
+        # Tolgo la registrazione così Stripe può riconsegnare l'evento
+        await db.stripe_events.delete_one({"id": event["id"]})
+        raise
+    return {"received": True}
+
+BOOKINGS_PAGE_MAX = 500
+
+def _encode_cursor(booking: dict) -> str:
+    raw = json.dumps([booking.get("created_at", ""), booking["id"]], default=str).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def _decode_cursor(cursor: str) -> tuple:
+    try:
+        created_at, booking_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        return str(created_at), str(booking_id)
+    except (ValueError, TypeError):
+        raise HTTPException(400, "Invalid cursor")
+
+async def normalize_booking_timestamps():
+    """Le vecchie importazioni iCal salvavano created_at/updated_at come date BSON: le
+    convertiamo in stringhe ISO come il resto, così ordinamento e cursori sono coerenti"""
+    for field in ("created_at", "updated_at"):
+        res = await db.bookings.update_many(
+            {field: {"$type": "date"}},
+            [{"$set": {field: {"$dateToString": {"date": f"${field}", "format": "%Y-%m-%dT%H:%M:%S.%L+00:00"}}}}]
+        )
+        if res.modified_count:
+            logger.info(f"Normalized {res.modified_count} booking {field} values")
 
 @api_router.get("/bookings")
-async def get_all_bookings():
-    return await db.bookings.find({}, {"_id": 0}).sort("created_at", -1).to_list(1000)
+async def get_all_bookings(
+    response: Response,
+    limit: int = Query(50, ge=1, le=BOOKINGS_PAGE_MAX),
+    cursor: Optional[str] = None,
+    status: Optional[str] = None,
+    room_id: Optional[str] = None,
+    source: Optional[str] = None,
+    check_in_from: Optional[str] = None,
+    check_in_to: Optional[str] = None,
+    check_out_from: Optional[str] = None,
+    check_out_to: Optional[str] = None,
+    fields: Optional[str] = None
+):
+    """Prenotazioni dalla più recente, paginate per chiave (created_at, id).
+
+    Il corpo resta una lista; il cursore della pagina successiva è nell'header X-Next-Cursor.
+    `fields` è una lista separata da virgole dei campi da restituire.
+    """
+    query = {}
+    for key, value in (("status", status), ("room_id", room_id), ("source", source)):
+        if value:
+            query[key] = value
+    for key, lower, upper in (("check_in", check_in_from, check_in_to), ("check_out", check_out_from, check_out_to)):
+        if lower:
+            query.setdefault(key, {})["$gte"] = lower
+        if upper:
+            query.setdefault(key, {})["$lte"] = upper
+    if cursor:
+        created_at, booking_id = _decode_cursor(cursor)
+        query["$or"] = [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "id": {"$lt": booking_id}}
+        ]
+
+    projection = {"_id": 0}
+    if fields:
+        projection.update({f.strip(): 1 for f in fields.split(",") if f.strip() and f.strip() != "_id"})
+        projection.update({"id": 1, "created_at": 1})
+
+    page = await db.bookings.find(query, projection).sort([("created_at", -1), ("id", -1)]).limit(limit + 1).to_list(limit + 1)
+    if len(page) > limit:
+        page = page[:limit]
+        response.headers["X-Next-Cursor"] = _encode_cursor(page[-1])
+    return page
 
 @api_router.put("/bookings/{booking_id}/status")
 async def update_booking_status(booking_id: str, status: str):
-    await db.bookings.update_one({"id": booking_id}, {"$set": {"status": status}})
+    before = await db.bookings.find_one_and_update(
+        {"id": booking_id}, {"$set": {"status": status}},
+        projection={"_id": 0}, return_document=ReturnDocument.BEFORE
+    )
+    if before:
+        booking = {**before, "status": status}
+        occupancy_index.apply_booking(booking)
+        await occupancy_index.bump(booking["room_id"])
+        if _affects_calendar_export(before, booking):
+            await invalidate_calendar_export(booking["room_id"])
+        if booking.get("stripe_session_id"):
+            resolved_sessions_cache.pop(booking["stripe_session_id"])
+        if before.get("status") != status:
+            await record_booking_transition(before, booking)
     return {"message": "Updated"}
 
+# --- EXPORT (CSV / NDJSON) ---
+EXPORT_CHUNK_ROWS = 500
+
+BOOKING_EXPORT_FIELDS = [
+    "id", "created_at", "room_id", "source", "status", "payment_status", "guest_name", "guest_email",
+    "guest_phone", "check_in", "check_out", "num_guests", "room_price", "upsells_total",
+    "discount_amount", "coupon_code", "total_price", "stripe_session_id"
+]
+PAYMENT_EXPORT_FIELDS = [
+    "id", "created_at", "updated_at", "booking_id", "session_id", "amount", "currency", "status", "payment_status"
+]
+
+def _created_range_query(start_date: Optional[str], end_date: Optional[str]) -> dict:
+    """Filtro su created_at (stringa ISO) per [start_date, end_date], estremi inclusi"""
+    query = {}
+    try:
+        if start_date:
+            query["$gte"] = date.fromisoformat(start_date).isoformat()
+        if end_date:
+            query["$lt"] = (date.fromisoformat(end_date) + timedelta(days=1)).isoformat()
+    except ValueError:
+        raise HTTPException(400, "Formato data non valido (YYYY-MM-DD)")
+    return {"created_at": query} if query else {}
+
+CSV_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+def _csv_safe(value):
+    """Neutralizza le celle che un foglio di calcolo interpreterebbe come formula (dati dal form pubblico)"""
+    if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+async def _iter_export(collection, query: dict, fields: List[str], fmt: str):
+    """Righe CSV/NDJSON a blocchi direttamente dal cursore: memoria costante"""
+    projection = {"_id": 0, **{f: 1 for f in fields}}
+    cursor = collection.find(query, projection).sort("created_at", 1).batch_size(EXPORT_CHUNK_ROWS)
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields, extrasaction="ignore") if fmt == "csv" else None
+    if writer:
+        writer.writeheader()
+    rows = 0
+    async for doc in cursor:
+        if writer:
+            writer.writerow({k: _csv_safe(v) for k, v in doc.items()})
+        else:
+            buffer.write(json.dumps(doc, default=str) + "\n")
+        rows += 1
+        if rows % EXPORT_CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def _export_response(collection, name: str, query: dict, fields: List[str], fmt: str) -> StreamingResponse:
+    if fmt not in ("csv", "ndjson"):
+        raise HTTPException(400, "format must be csv or ndjson")
+    media_type = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        _iter_export(collection, query, fields, fmt),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{name}.{fmt}"'}
+    )
+
+@api_router.get("/export/bookings", dependencies=[Depends(require_admin)])
+async def export_bookings(format: str = "csv", start_date: Optional[str] = None, end_date: Optional[str] = None,
+                          status: Optional[str] = None):
+    query = _created_range_query(start_date, end_date)
+    if status:
+        query["status"] = status
+    return _export_response(db.bookings, "bookings", query, BOOKING_EXPORT_FIELDS, format)
+
+@api_router.get("/export/payments", dependencies=[Depends(require_admin)])
+async def export_payments(format: str = "csv", start_date: Optional[str] = None, end_date: Optional[str] = None):
+    query = _created_range_query(start_date, end_date)
+    return _export_response(db.payment_transactions, "payments", query, PAYMENT_EXPORT_FIELDS, format)
+
 # --- REVIEWS ---
 @api_router.post("/reviews")
 async def create_review(data: ReviewCreate):
@@ -789,49 +2451,283 @@ async def get_messages():
 # --- ANALYTICS ---
 @api_router.get("/analytics/top-stats")
 async def get_top_stats():
-    today = datetime.now().strftime("%Y-%m-%d")
-    checkins = await db.bookings.count_documents({"check_in": today, "status": "confirmed"})
-    pending = await db.bookings.count_documents({"status": "pending"})
-    checkouts = await db.bookings.count_documents({"check_out": today, "status": "confirmed"})
-    first_day = date.today().replace(day=1).strftime("%Y-%m-%d")
-    bookings_month = await db.bookings.find({"created_at": {"$gte": first_day}, "status": "confirmed"}).to_list(1000)
-    month_revenue = sum(b.get('total_price', 0) for b in bookings_month)
+    # Letture su daily_stats (un documento per giorno e stanza), in un solo round trip
+    today = date.today().isoformat()
+    first_day = date.today().replace(day=1).isoformat()
+    totals = {"_id": None, "check_ins": {"$sum": "$check_ins"}, "check_outs": {"$sum": "$check_outs"},
+              "revenue": {"$sum": "$revenue"}, "pending": {"$sum": "$pending"}}
+    result = (await db.daily_stats.aggregate([{"$facet": {
+        "today": [{"$match": {"date": today}}, {"$group": totals}],
+        "month": [{"$match": {"date": {"$gte": first_day, "$lte": today}}}, {"$group": totals}],
+        "all": [{"$match": {"date": STATS_TOTALS_DAY}}, {"$group": totals}]
+    }}]).to_list(1))[0]
+    today_stats = result["today"][0] if result["today"] else {}
+    month_stats = result["month"][0] if result["month"] else {}
+    all_stats = result["all"][0] if result["all"] else {}
+    checkins = today_stats.get("check_ins", 0)
+    checkouts = today_stats.get("check_outs", 0)
+    pending = all_stats.get("pending", 0)
+    month_revenue = month_stats.get("revenue", 0)
     return {"todays_checkins": checkins, "pending_bookings": pending, "todays_checkouts": checkouts, "month_revenue": month_revenue}
 
+# Notti di un soggiorno calcolate in Mongo (null se le date non sono valide, ignorato da $sum)
+NIGHTS_EXPR = {"$divide": [
+    {"$subtract": [
+        {"$dateFromString": {"dateString": "$check_out", "format": "%Y-%m-%d", "onError": None}},
+        {"$dateFromString": {"dateString": "$check_in", "format": "%Y-%m-%d", "onError": None}}
+    ]},
+    86400000
+]}
+
 @api_router.get("/analytics/overview")
 async def get_analytics_overview(start_date: str = None, end_date: str = None):
-    query = {"status": "confirmed"}
-    if start_date and end_date:
-        query["check_in"] = {"$gte": start_date}
-    bookings = await db.bookings.find(query).to_list(2000)
-    total_revenue = 0.0
-    total_bookings = len(bookings)
-    nights_sold = 0
-    revenue_nonna = 0.0
-    bookings_nonna = 0
-    revenue_pozzo = 0.0
-    bookings_pozzo = 0
-    for b in bookings:
-        price = b.get('total_price', 0)
-        total_revenue += price
-        try:
-            d1 = datetime.strptime(b['check_in'], "%Y-%m-%d")
-            d2 = datetime.strptime(b['check_out'], "%Y-%m-%d")
-            nights_sold += (d2 - d1).days
-        except: pass
-        if b.get('room_id') == 'nonna': revenue_nonna += price; bookings_nonna += 1
-        elif b.get('room_id') == 'pozzo': revenue_pozzo += price; bookings_pozzo += 1
+    match = {}
+    if start_date:
+        match["check_in"] = {"$gte": start_date}
+    if end_date:
+        match.setdefault("check_in", {})["$lte"] = end_date
+    is_confirmed = {"$eq": ["$status", "confirmed"]}
+
+    pipeline = [
+        {"$match": match},
+        {"$project": {"_id": 0, "room_id": 1, "status": 1, "total_price": 1, "discount_amount": 1,
+                      "num_guests": 1, "coupon_code": 1, "check_in": 1, "check_out": 1}},
+        # Tutte le stanze compaiono in by_room, anche senza prenotazioni nel periodo
+        {"$unionWith": {"coll": "rooms", "pipeline": [{"$project": {"_id": 0, "room_id": "$id", "catalog": {"$literal": True}}}]}},
+        {"$facet": {
+            "summary": [
+                {"$match": {"status": "confirmed"}},
+                {"$group": {
+                    "_id": None,
+                    "revenue": {"$sum": "$total_price"},
+                    "bookings": {"$sum": 1},
+                    "nights": {"$sum": NIGHTS_EXPR},
+                    "discounts": {"$sum": "$discount_amount"},
+                    "avg_guests": {"$avg": "$num_guests"},
+                    "with_coupon": {"$sum": {"$cond": [{"$gt": [{"$ifNull": ["$coupon_code", ""]}, ""]}, 1, 0]}}
+                }}
+            ],
+            "by_room": [
+                {"$group": {
+                    "_id": "$room_id",
+                    "revenue": {"$sum": {"$cond": [is_confirmed, "$total_price", 0]}},
+                    "bookings": {"$sum": {"$cond": [is_confirmed, 1, 0]}}
+                }}
+            ],
+            "by_status": [
+                {"$match": {"catalog": {"$ne": True}}},
+                {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+            ]
+        }}
+    ]
+    facets = (await db.bookings.aggregate(pipeline).to_list(1))[0]
+
+    summary = facets["summary"][0] if facets["summary"] else {}
+    total_revenue = summary.get("revenue", 0.0)
+    total_bookings = summary.get("bookings", 0)
+    nights_sold = int(summary.get("nights") or 0)
+    by_status = {"pending": 0, "confirmed": 0, "cancelled": 0}
+    by_status.update({st["_id"]: st["count"] for st in facets["by_status"] if st["_id"]})
+    all_bookings = sum(by_status.values())
+
     occupancy_rate = 0
     if total_bookings > 0: occupancy_rate = round((nights_sold / (365 * 2)) * 100, 1)
     return {
-        "summary": {"total_revenue": total_revenue, "total_bookings": total_bookings, "occupancy_rate": occupancy_rate, "avg_price_per_night": round(total_revenue / nights_sold, 2) if nights_sold > 0 else 0, "total_nights": nights_sold},
-        "by_room": {"bookings": {"nonna": bookings_nonna, "pozzo": bookings_pozzo}, "revenue": {"nonna": revenue_nonna, "pozzo": revenue_pozzo}},
-        "by_status": {"pending": await db.bookings.count_documents({"status": "pending"}), "confirmed": total_bookings, "cancelled": await db.bookings.count_documents({"status": "cancelled"})}
+        "summary": {
+            "total_revenue": total_revenue,
+            "total_bookings": total_bookings,
+            "occupancy_rate": occupancy_rate,
+            "avg_price_per_night": round(total_revenue / nights_sold, 2) if nights_sold > 0 else 0,
+            "total_nights": nights_sold,
+            "total_discounts": summary.get("discounts", 0.0),
+            "avg_guests": round(summary.get("avg_guests") or 0, 1),
+            "coupon_usage_rate": round(summary.get("with_coupon", 0) / total_bookings * 100, 1) if total_bookings else 0,
+            "conversion_rate": round(total_bookings / all_bookings * 100, 1) if all_bookings else 0
+        },
+        "by_room": {
+            "bookings": {r["_id"]: r["bookings"] for r in facets["by_room"] if r["_id"]},
+            "revenue": {r["_id"]: r["revenue"] for r in facets["by_room"] if r["_id"]}
+        },
+        "by_status": by_status
+    }
+
+MONTH_NAMES_IT = ["Gennaio", "Febbraio", "Marzo", "Aprile", "Maggio", "Giugno", "Luglio",
+                  "Agosto", "Settembre", "Ottobre", "Novembre", "Dicembre"]
+
+# Mesi chiusi già calcolati: (anno, mese) -> {room_id: {nights, revenue, bookings}}
+monthly_stats_cache: Dict[tuple, Dict[str, dict]] = {}
+
+async def _compute_monthly(start: date, end: date) -> Dict[int, Dict[str, dict]]:
+    """Notti, ricavi e prenotazioni per mese e stanza nella finestra [start, end).
+
+    Ogni soggiorno viene spezzato nelle sue notti, così le notti (e il ricavo, ripartito
+    per notte) cadono nel mese in cui sono effettivamente trascorse.
+    """
+    day_ms = 86400000
+    window_start = datetime(start.year, start.month, start.day)
+    window_end = datetime(end.year, end.month, end.day)
+    pipeline = [
+        {"$match": {"status": "confirmed", "check_in": {"$lt": end.isoformat()}, "check_out": {"$gt": start.isoformat()}}},
+        {"$project": {
+            "_id": 0, "room_id": 1, "total_price": 1,
+            "ci": {"$dateFromString": {"dateString": "$check_in", "format": "%Y-%m-%d", "onError": None}},
+            "co": {"$dateFromString": {"dateString": "$check_out", "format": "%Y-%m-%d", "onError": None}}
+        }},
+        {"$addFields": {"nights": {"$toInt": {"$divide": [{"$subtract": ["$co", "$ci"]}, day_ms]}}}},
+        {"$match": {"nights": {"$gt": 0}}},
+        {"$addFields": {"night": {"$map": {
+            "input": {"$range": [0, "$nights"]},
+            "as": "i",
+            "in": {"$add": ["$ci", {"$multiply": ["$$i", day_ms]}]}
+        }}}},
+        {"$unwind": "$night"},
+        {"$match": {"night": {"$gte": window_start, "$lt": window_end}}},
+        {"$group": {
+            "_id": {"month": {"$month": "$night"}, "room_id": "$room_id"},
+            "nights": {"$sum": 1},
+            "revenue": {"$sum": {"$divide": [{"$ifNull": ["$total_price", 0]}, "$nights"]}},
+            # Una prenotazione conta nel mese del suo check-in
+            "bookings": {"$sum": {"$cond": [{"$eq": ["$night", "$ci"]}, 1, 0]}}
+        }}
+    ]
+    months: Dict[int, Dict[str, dict]] = {}
+    async for row in db.bookings.aggregate(pipeline):
+        months.setdefault(row["_id"]["month"], {})[row["_id"]["room_id"]] = {
+            "nights": row["nights"], "revenue": row["revenue"], "bookings": row["bookings"]
+        }
+    return months
+
+def _month_summary(year: int, month: int, by_room: Dict[str, dict], room_ids: List[str]) -> dict:
+    days = ((date(year + month // 12, month % 12 + 1, 1)) - date(year, month, 1)).days
+    rooms = {}
+    for room_id in sorted(set(room_ids) | set(by_room)):
+        r = by_room.get(room_id, {"nights": 0, "revenue": 0.0, "bookings": 0})
+        rooms[room_id] = {
+            "revenue": round(r["revenue"], 2),
+            "nights": r["nights"],
+            "bookings": r["bookings"],
+            "occupancy": round(r["nights"] / days * 100, 1),
+            "adr": round(r["revenue"] / r["nights"], 2) if r["nights"] else 0
+        }
+    nights = sum(r["nights"] for r in rooms.values())
+    revenue = sum(r["revenue"] for r in rooms.values())
+    return {
+        "month": month,
+        "month_name": MONTH_NAMES_IT[month - 1],
+        "revenue": round(revenue, 2),
+        "nights": nights,
+        "bookings": sum(r["bookings"] for r in rooms.values()),
+        "occupancy": round(nights / (days * len(room_ids)) * 100, 1) if room_ids else 0,
+        "adr": round(revenue / nights, 2) if nights else 0,
+        "by_room": rooms
     }
 
 @api_router.get("/analytics/monthly")
-async def get_monthly(year: int = 2025):
-    return {"months": []}
+async def get_monthly(year: int = 2025, refresh: bool = False):
+    """Andamento mensile: i mesi chiusi restano in cache, si ricalcolano solo il mese corrente e i successivi"""
+    today = date.today()
+    if refresh:
+        for key in [k for k in monthly_stats_cache if k[0] == year]:
+            del monthly_stats_cache[key]
+
+    first_open = 13 if year < today.year else (1 if year > today.year else today.month)
+    first_missing = next((m for m in range(1, first_open) if (year, m) not in monthly_stats_cache), first_open)
+    computed = {}
+    if first_missing <= 12:
+        computed = await _compute_monthly(date(year, first_missing, 1), date(year + 1, 1, 1))
+        for m in range(first_missing, first_open):
+            monthly_stats_cache[(year, m)] = computed.get(m, {})
+
+    room_ids = [r["id"] for r in await db.rooms.find({}, {"_id": 0, "id": 1}).to_list(100)]
+    months = []
+    for m in range(1, 13):
+        by_room = monthly_stats_cache[(year, m)] if m < first_open else computed.get(m, {})
+        months.append(_month_summary(year, m, by_room, room_ids))
+    return {"year": year, "months": months}
+
+OCCUPANCY_MAX_DAYS = 3 * 366
+
+@api_router.get("/analytics/occupancy")
+async def get_occupancy(start_date: str, end_date: str):
+    """Matrice stanza x giorno su [start_date, end_date]: 0 libero, 1 venduto, 2 bloccato.
+
+    Conta come venduta ogni notte di prenotazioni confermate (sito e iCal importati);
+    le prenotazioni cancellate o in attesa non occupano. I giorni bloccati (non venduti)
+    sono esclusi dalle notti disponibili.
+    """
+    try:
+        start = date.fromisoformat(start_date)
+        end = date.fromisoformat(end_date)
+    except ValueError:
+        raise HTTPException(400, "Formato data non valido (YYYY-MM-DD)")
+    num_days = (end - start).days + 1
+    if num_days <= 0 or num_days > OCCUPANCY_MAX_DAYS:
+        raise HTTPException(400, f"Intervallo non valido (massimo {OCCUPANCY_MAX_DAYS} giorni)")
+    # Confronti tra stringhe solo sulla forma canonica YYYY-MM-DD (fromisoformat accetta anche 20250101)
+    start_date = start.isoformat()
+    end_date = end.isoformat()
+    window_end = (end + timedelta(days=1)).isoformat()
+
+    rooms, bookings, blocked = await asyncio.gather(
+        db.rooms.find({}, {"_id": 0, "id": 1}).to_list(100),
+        db.bookings.find(
+            {"status": "confirmed", "check_in": {"$lt": window_end}, "check_out": {"$gt": start_date}},
+            {"_id": 0, "room_id": 1, "check_in": 1, "check_out": 1}
+        ).to_list(None),
+        db.blocked_dates.find(
+            {"start": {"$lt": window_end}, "end": {"$gt": start_date}},
+            {"_id": 0, "room_id": 1, "start": 1, "end": 1}
+        ).to_list(None)
+    )
+    room_ids = [r["id"] for r in rooms]
+    room_pos = {room_id: i for i, room_id in enumerate(room_ids)}
+    base = start.toordinal()
+
+    def coverage(docs: List[dict], start_key: str, end_key: str) -> np.ndarray:
+        """Notti coperte per stanza e giorno, tramite differenze prime e somma cumulata"""
+        diff = np.zeros((len(room_ids), num_days + 1), dtype=np.int32)
+        docs = [d for d in docs if d.get("room_id") in room_pos]
+        if docs:
+            rows = np.fromiter((room_pos[d["room_id"]] for d in docs), dtype=np.int64, count=len(docs))
+            starts = np.fromiter((_day_ordinal(d[start_key]) - base for d in docs), dtype=np.int64, count=len(docs))
+            ends = np.fromiter((_day_ordinal(d[end_key]) - base for d in docs), dtype=np.int64, count=len(docs))
+            starts = np.clip(starts, 0, num_days)
+            ends = np.clip(ends, 0, num_days)
+            valid = ends > starts
+            np.add.at(diff, (rows[valid], starts[valid]), 1)
+            np.add.at(diff, (rows[valid], ends[valid]), -1)
+        return np.cumsum(diff, axis=1)[:, :num_days] > 0
+
+    booked = coverage(bookings, "check_in", "check_out")
+    blocked_days = coverage(blocked, "start", "end") & ~booked
+    matrix = booked.astype(np.int8) + 2 * blocked_days.astype(np.int8)
+
+    booked_nights = booked.sum(axis=1)
+    available_nights = num_days - blocked_days.sum(axis=1)
+    by_room = {
+        room_id: {
+            "booked_nights": int(booked_nights[i]),
+            "blocked_nights": int(num_days - available_nights[i]),
+            "available_nights": int(available_nights[i]),
+            "occupancy_rate": round(float(booked_nights[i]) / available_nights[i] * 100, 1) if available_nights[i] else 0
+        }
+        for i, room_id in enumerate(room_ids)
+    }
+    total_booked = int(booked_nights.sum())
+    total_available = int(available_nights.sum())
+    return {
+        "start_date": start_date,
+        "end_date": end_date,
+        "days": [date.fromordinal(base + i).isoformat() for i in range(num_days)],
+        "rooms": room_ids,
+        "matrix": {room_id: matrix[i].tolist() for i, room_id in enumerate(room_ids)},
+        "by_room": by_room,
+        "summary": {
+            "booked_nights": total_booked,
+            "available_nights": total_available,
+            "occupancy_rate": round(total_booked / total_available * 100, 1) if total_available else 0
+        }
+    }
 
 @api_router.get("/analytics/recent-bookings")
 async def get_recent_bookings():
@@ -859,19 +2755,22 @@ async def admin_login(data: AdminLogin):
     received_hash = hash_password(data.password)
     if data.username == ADMIN_USERNAME and received_hash == ADMIN_PASSWORD_HASH:
         token = secrets.token_urlsafe(32)
-        await db.admin_sessions.insert_one({"token": token, "expires_at": (datetime.now(timezone.utc)+timedelta(hours=24)).isoformat()})
+        expires_at = datetime.now(timezone.utc) + timedelta(hours=ADMIN_SESSION_HOURS)
+        # expires_at come data BSON, così l'indice TTL può rimuovere la sessione
+        await db.admin_sessions.insert_one({"token": token, "expires_at": expires_at})
+        admin_token_cache.set(token, expires_at)
         return {"success": True, "token": token}
     raise HTTPException(401, "Invalid")
 
 @api_router.get("/admin/verify")
 async def verify_token(token: str):
-    s = await db.admin_sessions.find_one({"token": token})
-    if s and datetime.fromisoformat(s["expires_at"]) > datetime.now(timezone.utc):
+    if await is_admin_token_valid(token):
         return {"valid": True}
     raise HTTPException(401, "Expired")
 
 @api_router.post("/admin/logout")
 async def logout(token: str):
+    admin_token_cache.pop(token)
     await db.admin_sessions.delete_one({"token": token})
     return {"success": True}
 
@@ -881,4 +2780,12 @@ async def get_stay_reasons():
 
 # ==================== STARTUP ====================
 app.include_router(api_router)
-app.add_middleware(CORSMiddleware, allow_credentials=True, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
\ No newline at end of file
+app.add_middleware(CORSMiddleware, allow_credentials=True, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"], expose_headers=["X-Next-Cursor", "ETag"])
+
+if __name__ == "__main__":
+    # Comandi di manutenzione: python server.py rebuild-daily-stats
+    import sys
+    if sys.argv[1:] == ["rebuild-daily-stats"]:
+        asyncio.run(rebuild_daily_stats())
+    else:
+        print("Usage: python server.py rebuild-daily-stats")
\ No newline at end of file
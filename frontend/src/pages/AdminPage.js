@@ -99,6 +99,9 @@ const AdminPage = () => {
   const [activeTab, setActiveTab] = useState('analytics');
   const [rooms, setRooms] = useState([]);
   const [bookings, setBookings] = useState([]);
+  const [bookingsCursor, setBookingsCursor] = useState(null);
+  const [bookingFilters, setBookingFilters] = useState({ status: '', room_id: '' });
+  const [loadingMoreBookings, setLoadingMoreBookings] = useState(false);
   const [reviews, setReviews] = useState([]);
   const [messages, setMessages] = useState([]);
   const [coupons, setCoupons] = useState([]);
@@ -187,7 +190,7 @@ const AdminPage = () => {
       fetchData();
     }
     // eslint-disable-next-line react-hooks/exhaustive-deps
-  }, [activeTab, isAuthenticated, selectedYear, dateFilter, customStart, customEnd]);
+  }, [activeTab, isAuthenticated, selectedYear, dateFilter, customStart, customEnd, bookingFilters]);
 
   const getDateRange = () => {
     const now = new Date();
@@ -202,6 +205,27 @@ const AdminPage = () => {
     return { start: `${now.getFullYear()}-01-01`, end: format(now, 'yyyy-MM-dd') };
   };
 
+  // Prenotazioni paginate: il backend restituisce il cursore della pagina successiva in X-Next-Cursor
+  const fetchBookingsPage = async (cursor) => {
+    const params = { limit: 100 };
+    if (cursor) params.cursor = cursor;
+    if (bookingFilters.status) params.status = bookingFilters.status;
+    if (bookingFilters.room_id) params.room_id = bookingFilters.room_id;
+    const response = await axios.get(`${API}/bookings`, { params });
+    return { items: response.data, next: response.headers['x-next-cursor'] || null };
+  };
+
+  const handleLoadMoreBookings = async () => {
+    if (!bookingsCursor) return;
+    setLoadingMoreBookings(true);
+    try {
+      const page = await fetchBookingsPage(bookingsCursor);
+      setBookings((prev) => [...prev, ...page.items]);
+      setBookingsCursor(page.next);
+    } catch { toast.error('Errore nel caricamento'); }
+    setLoadingMoreBookings(false);
+  };
+
   const fetchData = async () => {
     setLoading(true);
     try {
@@ -226,8 +250,9 @@ const AdminPage = () => {
         setRooms(roomsRes.data);
         setSiteImages(imagesRes.data);
       } else if (activeTab === 'bookings') {
-        const response = await axios.get(`${API}/bookings`);
-        setBookings(response.data);
+        const page = await fetchBookingsPage(null);
+        setBookings(page.items);
+        setBookingsCursor(page.next);
       } else if (activeTab === 'dates') {
         const [roomsRes, nonnaBlocked, pozzoBlocked] = await Promise.all([
           axios.get(`${API}/rooms`),
@@ -909,6 +934,20 @@ const AdminPage = () => {
               {activeTab === 'bookings' && (
                 <motion.div initial={{ opacity: 0 }} animate={{ opacity: 1 }}>
                   <h1 className="font-heading text-3xl text-adriatic-blue mb-8">Prenotazioni</h1>
+                  <div className="flex flex-wrap items-center gap-4 mb-6">
+                    <select value={bookingFilters.status} onChange={(e) => setBookingFilters({ ...bookingFilters, status: e.target.value })} className="border border-puglia-stone p-2 text-sm">
+                      <option value="">Tutti gli stati</option>
+                      <option value="pending">Pending</option>
+                      <option value="confirmed">Confirmed</option>
+                      <option value="cancelled">Cancelled</option>
+                      <option value="completed">Completed</option>
+                    </select>
+                    <select value={bookingFilters.room_id} onChange={(e) => setBookingFilters({ ...bookingFilters, room_id: e.target.value })} className="border border-puglia-stone p-2 text-sm">
+                      <option value="">Tutte le stanze</option>
+                      <option value="nonna">Nonna</option>
+                      <option value="pozzo">Pozzo</option>
+                    </select>
+                  </div>
                   {bookings.length === 0 ? <p className="text-muted-foreground">Nessuna prenotazione</p> : (
                     <div className="overflow-x-auto">
                       <table className="admin-table">
@@ -948,6 +987,13 @@ const AdminPage = () => {
                           ))}
                         </tbody>
                       </table>
+                      {bookingsCursor && (
+                        <div className="flex justify-center mt-6">
+                          <Button variant="outline" onClick={handleLoadMoreBookings} disabled={loadingMoreBookings}>
+                            {loadingMoreBookings ? 'Caricamento...' : 'Carica altre prenotazioni'}
+                          </Button>
+                        </div>
+                      )}
                     </div>
                   )}
                 </motion.div>
@@ -123,6 +123,18 @@ const BookingPage = () => {
 
   const selectedRoomData = rooms.find(r => r.id === selectedRoom);
   const nights = dateRange.from && dateRange.to ? differenceInDays(dateRange.to, dateRange.from) : 0;
+
+  // Se il soggiorno si accorcia, togli gli extra che richiedono più notti (il backend non li addebita)
+  useEffect(() => {
+    if (!nights) return;
+    setSelectedUpsells(prev => {
+      const eligible = prev.filter(id => {
+        const upsell = upsells.find(u => u.id === id);
+        return upsell && upsell.min_nights <= nights;
+      });
+      return eligible.length === prev.length ? prev : eligible;
+    });
+  }, [nights, upsells]);
   
   const calculateRoomPrice = () => {
     if (!selectedRoomData || !dateRange.from || !dateRange.to) return 0;
@@ -215,7 +227,8 @@ const BookingPage = () => {
         origin_url: window.location.origin,
         coupon_code: couponStatus === 'valid' ? formData.coupon_code : null,
         upsell_ids: selectedUpsells.length > 0 ? selectedUpsells : null,
-        stay_reason: formData.stay_reason || null
+        stay_reason: formData.stay_reason || null,
+        language
       };
 
       const response = await axios.post(`${API}/bookings`, bookingData);
@@ -384,5 +384,242 @@ class TestAdminEndpoints:
             print(f"✓ Restored original price €{original_price}")
 
 
+class TestBlockedDates:
+    """Test blocked date intervals: block, merge, split and per-day unblock"""
+    
+    ROOM_ID = "pozzo"
+    
+    @staticmethod
+    def _day(offset):
+        return (datetime.now() + timedelta(days=500 + offset)).strftime("%Y-%m-%d")
+    
+    def _block(self, start, end, reason):
+        response = requests.post(f"{BASE_URL}/api/blocked-dates/range", params={
+            "room_id": self.ROOM_ID, "start_date": self._day(start), "end_date": self._day(end), "reason": reason
+        })
+        assert response.status_code == 200
+        return response.json()
+    
+    def _intervals(self):
+        """Intervals inside the test window, as (start_offset, end_offset_exclusive, reason)"""
+        response = requests.get(f"{BASE_URL}/api/blocked-dates/{self.ROOM_ID}?intervals=true")
+        assert response.status_code == 200
+        window = (self._day(0), self._day(30))
+        offsets = {self._day(i): i for i in range(0, 31)}
+        return sorted(
+            (offsets[b["start"]], offsets[b["end"]], b["reason"])
+            for b in response.json()
+            if window[0] <= b["start"] and b["end"] <= window[1]
+        )
+    
+    def setup_method(self):
+        requests.delete(f"{BASE_URL}/api/blocked-dates/range", params={
+            "room_id": self.ROOM_ID, "start_date": self._day(0), "end_date": self._day(29)
+        })
+    
+    teardown_method = setup_method
+    
+    def test_block_range(self):
+        """POST /api/blocked-dates/range - end_date is inclusive, stored end is exclusive"""
+        data = self._block(5, 7, "Bloccato")
+        assert "3 date bloccate" in data["message"]
+        assert self._intervals() == [(5, 8, "Bloccato")]
+        
+        # Per-day view still lists every blocked night
+        days = requests.get(f"{BASE_URL}/api/blocked-dates/{self.ROOM_ID}").json()
+        blocked = {d["date"] for d in days}
+        assert {self._day(5), self._day(6), self._day(7)} <= blocked
+        assert self._day(8) not in blocked
+        print("✓ Blocked 3 days as a single interval")
+    
+    def test_merge_same_reason(self):
+        """Adjacent and overlapping ranges with the same reason are merged"""
+        self._block(5, 7, "Bloccato")
+        self._block(8, 9, "Bloccato")
+        data = self._block(9, 11, "Bloccato")
+        assert "2 date bloccate" in data["message"]
+        assert self._intervals() == [(5, 12, "Bloccato")]
+        print("✓ Same-reason ranges merged into one interval")
+    
+    def test_different_reason_not_merged(self):
+        """An adjacent range with another reason keeps its own reason"""
+        self._block(5, 7, "Ristrutturazione")
+        self._block(8, 9, "Bloccato")
+        assert self._intervals() == [(5, 8, "Ristrutturazione"), (8, 10, "Bloccato")]
+        print("✓ Adjacent ranges with different reasons kept apart")
+    
+    def test_overlap_splits_other_reason(self):
+        """Blocking inside a differently-reasoned interval splits it at the new bounds"""
+        self._block(5, 14, "Ristrutturazione")
+        data = self._block(8, 9, "Bloccato")
+        assert "0 date bloccate" in data["message"]
+        assert self._intervals() == [
+            (5, 8, "Ristrutturazione"), (8, 10, "Bloccato"), (10, 15, "Ristrutturazione")
+        ]
+        print("✓ Differently-reasoned interval split around the new range")
+    
+    def test_unblock_single_day_splits_interval(self):
+        """DELETE /api/blocked-dates/{room_id}/{date} - frees one night and splits the interval"""
+        self._block(5, 9, "Bloccato")
+        response = requests.delete(f"{BASE_URL}/api/blocked-dates/{self.ROOM_ID}/{self._day(7)}")
+        assert response.status_code == 200
+        assert self._intervals() == [(5, 7, "Bloccato"), (8, 10, "Bloccato")]
+        print("✓ Per-day unblock split the interval in two")
+    
+    def test_unblock_range(self):
+        """DELETE /api/blocked-dates/range - frees only the overlapping nights"""
+        self._block(5, 9, "Bloccato")
+        response = requests.delete(f"{BASE_URL}/api/blocked-dates/range", params={
+            "room_id": self.ROOM_ID, "start_date": self._day(4), "end_date": self._day(6)
+        })
+        assert response.status_code == 200
+        assert "2 date sbloccate" in response.json()["message"]
+        assert self._intervals() == [(7, 10, "Bloccato")]
+        print("✓ Range unblock trimmed the interval")
+
+
+def _create_confirmed_booking(room_id, check_in, check_out):
+    """Create a booking through the public API and confirm it as the admin would"""
+    response = requests.post(f"{BASE_URL}/api/bookings", json={
+        "room_id": room_id,
+        "guest_email": "test-analytics@example.com",
+        "guest_name": "Test Analytics",
+        "check_in": check_in,
+        "check_out": check_out,
+        "num_guests": 2,
+        "origin_url": "https://test.com"
+    })
+    assert response.status_code == 200
+    data = response.json()
+    confirm = requests.put(f"{BASE_URL}/api/bookings/{data['booking_id']}/status?status=confirmed")
+    assert confirm.status_code == 200
+    return data
+
+
+def _cancel_booking(booking_id):
+    requests.put(f"{BASE_URL}/api/bookings/{booking_id}/status?status=cancelled")
+
+
+class TestAnalytics:
+    """Test monthly and overview analytics with a stay crossing a month boundary"""
+    
+    YEAR = datetime.now().year + 3
+    ROOM_ID = "nonna"
+    
+    def _monthly(self):
+        response = requests.get(f"{BASE_URL}/api/analytics/monthly?year={self.YEAR}&refresh=true")
+        assert response.status_code == 200
+        return {m["month"]: m["by_room"][self.ROOM_ID] for m in response.json()["months"]}
+    
+    def _overview(self, start_date, end_date):
+        response = requests.get(f"{BASE_URL}/api/analytics/overview?start_date={start_date}&end_date={end_date}")
+        assert response.status_code == 200
+        return response.json()
+    
+    def test_monthly_splits_stay_across_months(self):
+        """GET /api/analytics/monthly - nights and revenue fall in the month they are spent"""
+        before = self._monthly()
+        booking = _create_confirmed_booking(self.ROOM_ID, f"{self.YEAR}-01-30", f"{self.YEAR}-02-02")
+        try:
+            after = self._monthly()
+            # 30 and 31 January in January, 1 February in February
+            assert after[1]["nights"] - before[1]["nights"] == 2
+            assert after[2]["nights"] - before[2]["nights"] == 1
+            # The booking counts once, in the month of its check-in
+            assert after[1]["bookings"] - before[1]["bookings"] == 1
+            assert after[2]["bookings"] - before[2]["bookings"] == 0
+            # Revenue is spread per night
+            jan_revenue = after[1]["revenue"] - before[1]["revenue"]
+            feb_revenue = after[2]["revenue"] - before[2]["revenue"]
+            assert abs(jan_revenue - booking["total_price"] * 2 / 3) < 0.05
+            assert abs(feb_revenue - booking["total_price"] / 3) < 0.05
+            print(f"✓ Stay split across months: Jan €{jan_revenue:.2f}, Feb €{feb_revenue:.2f}")
+        finally:
+            _cancel_booking(booking["booking_id"])
+    
+    def test_overview_date_bounds(self):
+        """GET /api/analytics/overview - check_in filter includes both bounds"""
+        day = f"{self.YEAR}-03-15"
+        inside_before = self._overview(day, day)["summary"]["total_bookings"]
+        after_day = self._overview(f"{self.YEAR}-03-16", f"{self.YEAR}-03-31")["summary"]["total_bookings"]
+        before_day = self._overview(f"{self.YEAR}-03-01", f"{self.YEAR}-03-14")["summary"]["total_bookings"]
+        
+        booking = _create_confirmed_booking(self.ROOM_ID, day, f"{self.YEAR}-03-17")
+        try:
+            assert self._overview(day, day)["summary"]["total_bookings"] == inside_before + 1
+            assert self._overview(f"{self.YEAR}-03-01", day)["summary"]["total_bookings"] >= inside_before + 1
+            # Excluded when the window starts after or ends before the check-in
+            assert self._overview(f"{self.YEAR}-03-16", f"{self.YEAR}-03-31")["summary"]["total_bookings"] == after_day
+            assert self._overview(f"{self.YEAR}-03-01", f"{self.YEAR}-03-14")["summary"]["total_bookings"] == before_day
+            print("✓ Overview bounds include the check-in day only when it falls in the window")
+        finally:
+            _cancel_booking(booking["booking_id"])
+
+
+class TestBookingsPagination:
+    """Test keyset pagination of GET /api/bookings"""
+    
+    def _page(self, cursor=None, limit=3):
+        params = {"limit": limit, "fields": "id,created_at"}
+        if cursor:
+            params["cursor"] = cursor
+        response = requests.get(f"{BASE_URL}/api/bookings", params=params)
+        assert response.status_code == 200
+        return response.json(), response.headers.get("X-Next-Cursor")
+    
+    def test_cursor_pages_are_disjoint_and_ordered(self):
+        """Following X-Next-Cursor yields the same sequence as a single large page"""
+        seen = []
+        cursor = None
+        for _ in range(3):
+            page, cursor = self._page(cursor)
+            seen.extend(page)
+            if not cursor:
+                break
+        if not seen:
+            pytest.skip("No bookings to page through")
+        
+        full, _ = self._page(limit=len(seen))
+        assert [b["id"] for b in seen] == [b["id"] for b in full]
+        assert len({b["id"] for b in seen}) == len(seen)
+        keys = [(b["created_at"], b["id"]) for b in seen]
+        assert keys == sorted(keys, reverse=True)
+        print(f"✓ {len(seen)} bookings paged consistently")
+    
+    def test_cursor_stable_when_new_bookings_arrive(self):
+        """A booking created between pages does not shift or duplicate later pages"""
+        first, cursor = self._page()
+        if not cursor:
+            pytest.skip("Not enough bookings for a second page")
+        
+        booking = _create_confirmed_booking("pozzo", f"{datetime.now().year + 3}-05-10", f"{datetime.now().year + 3}-05-12")
+        try:
+            second, _ = self._page(cursor)
+            first_ids = {b["id"] for b in first}
+            assert booking["booking_id"] not in {b["id"] for b in second}
+            assert not first_ids & {b["id"] for b in second}
+            assert (second[0]["created_at"], second[0]["id"]) < (first[-1]["created_at"], first[-1]["id"])
+            print("✓ Second page unaffected by a newly created booking")
+        finally:
+            _cancel_booking(booking["booking_id"])
+
+
+class TestICalSync:
+    """Test the manual iCal import endpoint used by the cron job and the admin"""
+    
+    def test_ical_sync(self):
+        """GET /api/ical/sync - syncs the feeds and reports changes, unchanged feeds and errors"""
+        response = requests.get(f"{BASE_URL}/api/ical/sync", timeout=60)
+        assert response.status_code == 200
+        
+        data = response.json()
+        assert isinstance(data, dict)
+        assert "message" in data
+        assert set(data["changes"]) == {"upserted", "modified", "deleted"}
+        assert isinstance(data["unchanged"], list)
+        assert isinstance(data["errors"], list)
+        print(f"✓ iCal sync: {data['message']} changes={data['changes']}")
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v", "--tb=short"])